@@ -76,6 +76,9 @@ if __name__ == '__main__':
         },
         url='http://code.google.com/p/django-graphs/',
         zip_safe=True,
+        extras_require={
+            'numpy': ['numpy'], # optional accelerator (see README)
+        },
         dependency_links=(
             "http://cairographics.org/pycairo/",
         ),
@@ -16,8 +16,108 @@
 # along with django-graph.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division
+import math
+from array import array
 import render_utils
 import axis_decorations
+from graph import Statistics
+from font import TextBatch
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def gatherStatistics(series):
+    """
+    Combine the statistics kept by each series (a dict of title -> Series)
+    into one Statistics instance covering every value they hold.
+    """
+    statistics = Statistics()
+    for s in series.itervalues():
+        statistics.merge(s.stats)
+    return statistics
+
+def valueWindow(statistics, steps):
+    """
+    Get the window of a dependent axis over values with the given
+    statistics, divided into the given number of steps (see
+    Axis.getWindow).
+    """
+    # If num < 100 round up to nearest 5. If num > 100 don't round.
+    p_max = statistics.positive_max
+    if p_max < 100:
+        p_max = render_utils.roundUpToNearest(p_max, 5)
+    p_min = statistics.negative_min
+    if p_min < 100:
+        p_min = 0 - render_utils.roundUpToNearest(abs(p_min), 5) # re-invert
+
+    if p_min != 0 and p_max != 0: # no need to scale. avoid 0 div errors.
+        if abs(p_min) < p_max:
+            step_value = p_max / steps
+            p_min = step_value * round(p_min / step_value)
+        else:
+            step_value = p_min / steps
+            p_max = step_value * round(p_max / step_value)
+
+    return p_min, p_max
+
+def valueTicks(window, steps, tick):
+    """
+    Get the values in a dependent axis's window at which decorations with
+    the given tick type ('whole' or 'half') are rendered. Returns a tuple
+    in the form (list of values, increment).
+    """
+    if window[1] >= abs(window[0]):
+        focal_window = 1
+    else:
+        focal_window = 0
+    increment = abs(window[focal_window]) / steps
+    if tick == 'whole':
+        upper_lim = abs(window[1]) + increment
+    else:
+        upper_lim = abs(window[1])
+    return list(render_utils.frange(window[0], upper_lim, increment)), increment
+
+def axisLabels(scheme, type, series, categories, title):
+    """
+    Get every label an axis measures (for its dimensions and its
+    decorations), as (FontStyle, content, rotation) tuples for
+    FontBook.prefetch. Only the axis's scheme and data are needed, so a
+    graph can fetch the labels of its axes before laying any of them out.
+
+    Parameters:
+        scheme = the scheme of the axis (independent or dependent)
+        type = 'independent' or 'dependent'
+        series = the graph's series (a dict of title -> Series)
+        categories = the graph's categories
+        title = the title of the axis
+    """
+    s = scheme['labeling']
+    labels = []
+    def add(label_scheme, contents, rotation=None):
+        if label_scheme['enabled']:
+            if rotation is None:
+                rotation = label_scheme['rotation']
+            labels.extend((label_scheme['font'], c, rotation) for c in contents)
+    if type == 'independent':
+        titles = [cat.title for cat in categories]
+        strings = [str(t) for t in titles]
+        add(s['category-labels'], strings)
+        if any(isinstance(t, basestring) for t in titles):
+            add(s['category-labels'], strings, 0)
+        else:
+            formatter = s['category-labels']['number-formatter']
+            add(s['category-labels'], [formatter % t for t in titles], 0)
+    else:
+        add(s['value'], [str(x[0]) for x in categories])
+        steps = scheme['format']['steps']
+        window = valueWindow(gatherStatistics(series), steps)
+        if window[0] or window[1]: # no ticks on an empty window
+            add(s['value'], [s['value']['formatter'] % v for v in \
+                valueTicks(window, steps, 'whole')[0]])
+    add(s['title'], [title])
+    return labels
 
 class Axis(object):
 
@@ -32,25 +132,34 @@ class Axis(object):
             self.__setattr__(arg_name, arg_value)
         if self.type == 'independent':
             self.titles = [cat.title for cat in self.categories]
-        self.positive_data, self.negative_data = self.__sortData()
-        self.dimensions = self.getDimensions()
+            self.positive_data, self.negative_data = self.__sortData()
+        else:
+            self.statistics = self.__gatherStatistics()
         self.axisNumeric_p = self.isAxisNumeric()
         self.window = self.getWindow()
+        self.labelRotation = self.chooseLabelRotation()
+        self.dimensions = self.getDimensions()
         self.positioningRatio = self.__getPositioningRatio()
         self.decorations = []
+        self.__transform = None
+        self.__titleSlots = None
+        self.__visibleLabels = {} # tick type -> set of label indices
 
     def __sortData(self):
         """
-        Sort the data by whether values are positive or negative. Return a
-        tuple in the form (positive values, negative values).
+        Sort the titles by whether they are positive or negative. Return a
+        tuple in the form (positive titles, negative titles).
         """
-        if self.type == 'dependent':
-            sort_set = []
-            map(sort_set.extend, (c for c in self.categories))
-        else:
-            sort_set = self.titles
+        sort_set = self.titles
         return filter(lambda v: v > 0, sort_set), filter(lambda v: v < 0, sort_set)
 
+    def __gatherStatistics(self):
+        """
+        Combine the statistics kept by each series into one Statistics
+        instance covering every value on the (dependent) axis.
+        """
+        return gatherStatistics(self.series)
+
     # Object Properties -------------------------------------------------------
 
     def getDimensions(self):
@@ -71,7 +180,7 @@ class Axis(object):
                     [str(x.title) for x in self.series])[metric]
             if s['category-labels']['enabled']:
                 v += self.labelMaxDimensions(s['category-labels'], \
-                    map(str, self.titles))[metric]
+                    map(str, self.titles), rotation=self.labelRotation)[metric]
             if s['title']['enabled']:
                 v += self.labelMaxDimensions(s['title'], self.title)[metric]
         else:
@@ -82,10 +191,113 @@ class Axis(object):
                 v += self.labelMaxDimensions(s['title'], self.title)[metric]
         return v
 
+    def categoryLabelTexts(self):
+        """
+        Get the text of each category label, as CategoryLabels renders it.
+        """
+        if self.axisNumeric_p:
+            formatter = self.scheme['labeling']['category-labels']['number-formatter']
+            return [formatter % t for t in self.titles]
+        return map(str, self.titles)
+
+    def __labelThinning(self):
+        """
+        Get the thinning scheme of the category labels, or None if the axis
+        has no category labels to thin.
+        """
+        if self.type != 'independent' or not self.titles:
+            return None
+        s = self.scheme['labeling']['category-labels']
+        thinning = s.get('thinning')
+        if not s['enabled'] or not thinning or not thinning['enabled']:
+            return None
+        return thinning
+
+    def __labelFootprints(self, extents, rotation):
+        """
+        Get the length along the axis taken up by labels with the given
+        (unrotated) extents at a rotation.
+        """
+        if self.orientation == 'horizontal':
+            metric = 0 # width of the rotated text
+        else:
+            metric = 1 # height of the rotated text
+        return [render_utils.rotatedExtents(w, h, rotation)[metric] \
+            for w, h in extents]
+
+    def chooseLabelRotation(self):
+        """
+        Choose the rotation of the category labels: the scheme's rotation
+        if neighbouring labels won't collide, else the first of the
+        thinning scheme's rotations at which they won't, else the last of
+        them (and labels are thinned at render time, see visibleLabels).
+        The room each label gets is worked out from the length of the axis
+        once it's intercepted (see interceptAxis); until then, it's
+        estimated from the canvas, which the axis can't exceed.
+        """
+        thinning = self.__labelThinning()
+        if thinning is None:
+            if self.type == 'independent':
+                return self.scheme['labeling']['category-labels']['rotation']
+            return None # no category labels
+        s = self.scheme['labeling']['category-labels']
+        extents = s['font'].dimensions(self.categoryLabelTexts(), 0)
+        if getattr(self, 'intercept', None) is not None:
+            room = self.length
+        elif self.orientation == 'horizontal':
+            room = self.canvas_dimensions[0]
+        else:
+            room = self.canvas_dimensions[1]
+        spacing = room / len(self.titles)
+        rotations = [s['rotation']] + \
+            [r for r in thinning['rotations'] if r != s['rotation']]
+        for rotation in rotations:
+            footprints = self.__labelFootprints(extents, rotation)
+            if all((a + b) / 2 + thinning['gap'] <= spacing \
+                for a, b in zip(footprints, footprints[1:])):
+                return rotation
+        return rotations[-1]
+
+    def visibleLabels(self, tick):
+        """
+        Get the set of indices of the category labels (rendered at ticks of
+        the given type) to show, or None to show them all. Labels are swept
+        in order of position, and each is kept if it starts past the end of
+        the last one kept.
+        """
+        thinning = self.__labelThinning()
+        if thinning is None:
+            return None
+        if tick not in self.__visibleLabels:
+            s = self.scheme['labeling']['category-labels']
+            extents = s['font'].dimensions(self.categoryLabelTexts(), 0)
+            footprints = self.__labelFootprints(extents, self.labelRotation)
+            if self.orientation == 'horizontal':
+                centers = [p[0] for v, p in self.__ticks(tick)[0]]
+            else:
+                centers = [p[1] for v, p in self.__ticks(tick)[0]]
+            align = s['font'].style['align']
+            visible = set()
+            end = None
+            for i in sorted(xrange(len(centers)), key=centers.__getitem__):
+                if align == 'left':
+                    start = centers[i]
+                elif align == 'right':
+                    start = centers[i] - footprints[i]
+                else:
+                    start = centers[i] - footprints[i] / 2
+                if end is None or start >= end + thinning['gap']:
+                    visible.add(i)
+                    end = start + footprints[i]
+            self.__visibleLabels[tick] = visible
+        return self.__visibleLabels[tick]
+
     def isAxisNumeric(self):
         """
         Determine whether or not the axis's data contains no strings.
         """
+        if self.type == 'dependent':
+            return self.statistics.strings == 0
         strings_in = lambda d: any((isinstance(v, basestring) for v in d))
         if strings_in(self.positive_data) or strings_in(self.negative_data):
             return False
@@ -104,23 +316,7 @@ class Axis(object):
             # we only pay attention to len
             return 0 - len(self.negative_data), len(self.positive_data)
         else:
-            # If num < 100 round up to nearest 5. If num > 100 don't round.
-            p_max = render_utils.safe_max(self.positive_data)
-            if p_max < 100:
-                p_max = render_utils.roundUpToNearest(p_max, 5)
-            p_min = render_utils.safe_min(self.negative_data)
-            if p_min < 100:
-                p_min = 0 - render_utils.roundUpToNearest(abs(p_min), 5) # re-invert
-
-            if p_min != 0 and p_max != 0: # no need to scale. avoid 0 div errors.
-                if abs(p_min) < p_max:
-                    step_value = p_max / self.scheme['format']['steps']
-                    p_min = step_value * round(p_min / step_value)
-                else:
-                    step_value = p_min / self.scheme['format']['steps']
-                    p_max = step_value * round(p_max / step_value)
-
-            return p_min, p_max
+            return valueWindow(self.statistics, self.scheme['format']['steps'])
 
     def __getPositioningRatio(self):
         """
@@ -266,17 +462,20 @@ class Axis(object):
 
     # Methods -----------------------------------------------------------------
 
-    def labelMaxDimensions(self, label_scheme, contents, use_cache = True):
+    def labelMaxDimensions(self, label_scheme, contents, use_cache = True,
+        rotation = None):
         """
         Return the dimensions of the largest string in the contents list.
         Takes two arguments: label_scheme, and contents - where label_scheme
         is the scheme to apply to the labels in the contents list or tuple.
         If the use_cache argument is True (which it is by default), only the
         height or width will be calculated (shaving ~.004 seconds from proc.
-        time), and the other value will be 0.
+        time), and the other value will be 0. The labels are measured at
+        the scheme's rotation unless another rotation is given.
         """
-        text_dims = label_scheme['font'].dimensions(contents, \
-            label_scheme['rotation'])
+        if rotation is None:
+            rotation = label_scheme['rotation']
+        text_dims = label_scheme['font'].dimensions(contents, rotation)
         if not isinstance(text_dims, list):
             width, height = text_dims
         else:
@@ -287,48 +486,157 @@ class Axis(object):
         if 'margin-bottom' in label_scheme.keys(): height += label_scheme['margin-bottom']
         return (width, height)
 
+    @property
+    def transform(self):
+        """
+        The value -> pixel transform of the axis as a tuple in the form
+        ((x, y) position of zero, pixels per unit). It's computed once
+        the axis has been intercepted and then reused.
+        """
+        if self.__transform is None:
+            if self.bucketMode_p:
+                offset = 0
+            else:
+                offset = -1
+            if self.window[1] > self.window[0]:
+                # if positive is dominant
+                window = self.window[1] + offset
+            else:
+                # if negative is dominant
+                window = self.window[0] + offset
+            unit = (self.length - self.relZero) / window
+            border = self.borderOrigin
+            if self.orientation == 'horizontal':
+                zero = (border[0], border[1])
+            else:
+                zero = (border[0], border[1] - self.relOrigin[0])
+            self.__transform = (zero, unit)
+        return self.__transform
+
+    def __getTitleSlots(self):
+        if self.__titleSlots is None:
+            slots = {}
+            for i, t in enumerate(self.titles):
+                slots.setdefault(t, i) # first wins, like index()
+            self.__titleSlots = slots
+        return self.__titleSlots
+
+    def titleSlot(self, title):
+        """
+        Get the index of a category title on the axis.
+        """
+        try:
+            return self.__getTitleSlots()[title]
+        except KeyError:
+            raise ValueError('%r is not a title on this axis.' % title)
+
+    def prepare(self):
+        """
+        Compute the values the axis caches lazily (its transform and title
+        slots), so that it can then be read from several threads at once
+        (see LayerManager.renderAll). The axis must have been intercepted.
+        """
+        self.transform
+        if self.type == 'independent':
+            self.__getTitleSlots()
+
     def positionOfValue(self, value):
         """
         Get the position of a value on the axis. Returns a tuple of
         x, y coordinates.
         """
-        
-        if self.bucketMode_p:
-            offset = 0
-        else:
-            offset = -1
-        if self.window[1] > self.window[0]:
-            # if positive is dominant
-            window = self.window[1] + offset
-        else:
-            # if negative is dominant
-            window = self.window[0] + offset
-        unit = (self.length - self.relZero) / window
+        zero, unit = self.transform
         if isinstance(value, basestring):
-            value = self.titles.index(value)
-        if self.orientation == 'horizontal':
-            zero = (self.borderOrigin[0], self.borderOrigin[1])
-        else:
-            zero = (self.borderOrigin[0], self.borderOrigin[1] - self.relOrigin[0])
+            value = self.titleSlot(value)
         if self.orientation == 'horizontal':
             return zero[0] + (unit * value), zero[1]
         else:
             return zero[0], zero[1] - (unit * value)
 
+    def positionsOfValues(self, values):
+        """
+        Get the positions of a sequence of values along the axis (the x
+        coordinates if the axis is horizontal, or the y coordinates if
+        it's vertical) in one call. Returns a list.
+        """
+        zero, unit = self.transform
+        if not isinstance(values, array) and \
+            not (numpy is not None and isinstance(values, numpy.ndarray)):
+            values = [(self.titleSlot(v) if isinstance(v, basestring) else v) \
+                for v in values]
+        if self.orientation == 'horizontal':
+            origin = zero[0]
+        else:
+            origin, unit = zero[1], -unit
+        if numpy is not None:
+            return (numpy.asarray(values, 'd') * unit + origin).tolist()
+        return [origin + (unit * v) for v in values]
+
+    def pointsOfValues(self, values):
+        """
+        Get the positions of a sequence of values as a list of x, y
+        coordinate tuples.
+        """
+        zero = self.transform[0]
+        positions = self.positionsOfValues(values)
+        if self.orientation == 'horizontal':
+            return [(p, zero[1]) for p in positions]
+        else:
+            return [(zero[0], p) for p in positions]
+
     def interceptAxis(self, axis):
         """
         Specify an Axis object for the current Axis to
         intersect. Returns None.
         """
         self.intercept = axis
+        self.__transform = None
+        if self.__labelThinning() is not None:
+            # choose the label rotation again, now from the real length
+            rotation = self.chooseLabelRotation()
+            if rotation != self.labelRotation:
+                self.labelRotation = rotation
+                self.dimensions = self.getDimensions()
 
     # Rendering ---------------------------------------------------------------
 
+    def tickValues(self, tick):
+        """
+        Get the values at which decorations with the given tick type
+        ('whole' or 'half') are rendered. Returns a tuple in the form
+        (list of values, increment).
+        """
+        if self.type == 'dependent':
+            return valueTicks(self.window, self.scheme['format']['steps'], tick)
+        else:
+            return self.titles, 1 # fixed
+
+    def __ticks(self, tick):
+        """
+        Get the values and points at which to render decorations with the
+        given tick type ('whole' or 'half'). Returns a tuple in the form
+        (list of (value, point) tuples, increment).
+        """
+        values, increment = self.tickValues(tick)
+        if self.type == 'dependent':
+            if tick == 'whole':
+                points = self.pointsOfValues(values)
+            else:
+                points = self.pointsOfValues([v + (increment / 2) for v in values])
+        else:
+            points = self.pointsOfValues(xrange(len(values)))
+            if tick != 'whole':
+                shift = self.categoryWidth / 2
+                points = [(x + shift, y) for x, y in points]
+        return zip(values, points), increment
+
     def __decorateAtTicks(self, *objs):
         """
         Loop overhead is larger than the overhead of setting up the context
         on each loop (via initRendering method of the object at hand). Cute.
         """
+        ticks = {} # tick type -> (values and points, increment)
+        batch = TextBatch(self.context) # labels are drawn a style at a time
         for item in objs:
             # run these items for each tick on each axis
             self.context.save()
@@ -337,31 +645,13 @@ class Axis(object):
             item.axis = self
             item.initRendering()
             # do the loop
-            if self.type == 'dependent':
-                if self.window[1] >= abs(self.window[0]):
-                    focal_window = 1
-                else:
-                    focal_window = 0
-                increment = abs(self.window[focal_window]) / self.scheme['format']['steps']
-                if item.tick == 'whole':
-                    upper_lim = abs(self.window[1]) + increment
-                else:
-                    upper_lim = abs(self.window[1])
-                for pos in render_utils.frange(self.window[0], upper_lim, increment):
-                    if item.tick == 'whole':
-                        point = self.positionOfValue(pos)
-                    else:
-                        point = self.positionOfValue(pos + (increment / 2))
-                    item.render(value=pos, point=point, increment=increment)
-            else:
-                cat_width = self.categoryWidth
-                increment = 1 # fixed
-                for point, value in ((self.positionOfValue(i), v) for i, v in enumerate(self.titles)):
-                    if item.tick == 'whole':
-                        item.render(value=value, point=point, increment=increment)
-                    else:
-                        shifted_point = point[0] + (cat_width / 2), point[1]
-                        item.render(value=value, point=shifted_point, increment=increment)
+            if item.tick not in ticks:
+                ticks[item.tick] = self.__ticks(item.tick)
+            marks, increment = ticks[item.tick]
+            for index, (value, point) in enumerate(marks):
+                item.render(value=value, point=point, increment=increment,
+                    batch=batch, index=index)
+            batch.flush()
             # tell the object to paint itself and restore canvas
             if hasattr(item, 'finishRendering') and callable(item.finishRendering):
                 item.finishRendering()
@@ -389,6 +679,28 @@ class Axis(object):
     def importDecoration(self, decoration):
         self.decorations.append(decoration)
 
+    def cacheKey(self):
+        """
+        A tuple identifying what the axis draws, apart from its scheme
+        (see LayerManager.staticKey). This includes the geometry of both
+        the axis and the axis intercepting it, which depends on the data
+        (the widths of the value labels, for instance) as well as on the
+        kind of graph (bucket mode, fixed positions).
+        """
+        if self.type == 'independent':
+            labels = tuple(map(str, self.titles))
+        else:
+            labels = None
+        intercept = getattr(self, 'intercept', None)
+        if intercept is not None:
+            intercept = (intercept.dimensions, intercept.fix_position,
+                intercept.bucketMode_p)
+        return (self.type, self.orientation, tuple(self.window), self.title,
+            labels, tuple(self.canvas_position), tuple(self.canvas_dimensions),
+            self.dimensions, self.fix_position, self.bucketMode_p,
+            self.labelRotation, intercept,
+            tuple((d.__class__.__name__, d.tick) for d in self.decorations))
+
     def __debug(self):
         print '%s (%s) -----------------------------------------------' % (self.orientation, self.type)
         print 'getWindow(): %s' % repr(self.window)
@@ -59,6 +59,7 @@ class DependentValueLabels(object):
         self.scheme = scheme
         self.axis = None
         self.context = None
+        self.batch = None # a font.TextBatch, set by the axis
 
     def initRendering(self):
         self.context.set_antialias(1)
@@ -76,7 +77,8 @@ class DependentValueLabels(object):
             self.scheme['font'].render(
                 self.scheme['formatter'] % self.value,
                 (self.point[0] - self.scheme['margin-right'], self.point[1] - height / 2),
-                render_utils.dehumanizeRotation(self.scheme['rotation'])
+                render_utils.dehumanizeRotation(self.scheme['rotation']),
+                batch=self.batch
             )
 
 class CategoryLabels(object):
@@ -86,6 +88,8 @@ class CategoryLabels(object):
         self.scheme = scheme
         self.axis = None
         self.context = None
+        self.batch = None # a font.TextBatch, set by the axis
+        self.index = None # the label's index, set by the axis
 
     def initRendering(self):
         self.context.set_antialias(1)
@@ -98,19 +102,25 @@ class CategoryLabels(object):
         for arg_name, arg_value in kwargs.items():
             self.__setattr__(arg_name, arg_value)
 
+        visible = self.axis.visibleLabels(self.tick)
+        if visible is not None and self.index not in visible:
+            return # thinned out -- see Axis.visibleLabels
+
         if self.axis.axisNumeric_p:
             height = self.scheme['font'].dimensions(self.scheme['number-formatter'] % self.value)[1]
             self.scheme['font'].render(
                 self.scheme['number-formatter'] % self.value,
                 (self.point[0], self.point[1] + self.scheme['margin-top']),
-                render_utils.dehumanizeRotation(self.scheme['rotation'])
+                render_utils.dehumanizeRotation(self.axis.labelRotation),
+                batch=self.batch
             )
         else:
             height = self.scheme['font'].dimensions(self.value)[1]
             self.scheme['font'].render(
                 self.value,
                 (self.point[0], self.point[1] + self.scheme['margin-top']),
-                render_utils.dehumanizeRotation(self.scheme['rotation'])
+                render_utils.dehumanizeRotation(self.axis.labelRotation),
+                batch=self.batch
             )
 
 class Gridlines(object):
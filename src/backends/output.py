@@ -15,16 +15,38 @@
 # You should have received a copy of the GNU General Public License
 # along with django-graph.  If not, see <http://www.gnu.org/licenses/>.
 
+import abc
 import cairo
 import os
+import shutil
+import tempfile
 import cStringIO
+try:
+    from .. import render_utils # installed, as djangographs.backends
+except ValueError:
+    import render_utils # run from src/, where backends is a top-level package
 
 class OutputMethod(object):
+    """
+    OutputMethod() is the abstract baseclass of the output formats. Graphs
+    draw on OutputMethod.surface, and the document is written out with
+    writeToFile(), which accepts a path or any object with a write()
+    method (an open file, a socket's makefile(), Django's HttpResponse,
+    etc.) and writes to it as Cairo produces the document.
+
+    Subclasses must provide:
+        surface = a property creating (on first use) and returning the
+            Cairo surface of self.dimensions that graphs draw on
+        writeToFile(target) = write the document drawn on the surface to
+            target and return target
+    """
+
+    __metaclass__ = abc.ABCMeta
     
     def __init__(self):
         self._surface = None
         self._context = None
-        self._output = cStringIO.StringIO()
+        self._output = None
         self.dimensions = None
     
     @property
@@ -33,55 +55,97 @@ class OutputMethod(object):
             self._context = cairo.Context(self.surface)
         return self._context
 
-    def writeToFile(self, path):
-        self.surface.finish()
-        fh = open(path, 'w')
-        fh.write(self._output.getvalue())
-        return path
+    @abc.abstractproperty
+    def surface(self):
+        """
+        The Cairo surface graphs draw on.
+        """
+
+    @abc.abstractmethod
+    def writeToFile(self, target):
+        """
+        Write the document to target: a path, or any object with a write()
+        method. Returns target.
+        """
         
     def writeToString(self):
-        return self._output.getvalue()
+        output = cStringIO.StringIO()
+        self.writeToFile(output)
+        return output.getvalue()
 
 class PNG(OutputMethod):
     
-    def __init__(self):
-        self._surface = None
-        self._context = None
-        self.dimensions = None
-        
     @property
     def surface(self):
         if self.dimensions is None:
-            raise 'No dimensions loaded for PNG output.'
+            raise render_utils.RenderError('No dimensions loaded for PNG output.')
         if self._surface is None:
             self._surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *self.dimensions)
         return self._surface
     
-    def writeToFile(self, path):
-        self.surface.write_to_png(path)
-        return path
-    
-    def writeToString(self):
-        output = cStringIO.StringIO()
-        self.surface.write_to_png(output)
-        return output.getvalue()
+    def writeToFile(self, target):
+        self.surface.write_to_png(target) # a path or a file-like object
+        return target
+
+class VectorOutputMethod(OutputMethod):
+    """
+    VectorOutputMethod() is the baseclass of vector formats (SVG, PDF).
+    Graphs draw on a RecordingSurface, which is replayed onto a surface of
+    the right format created on the target when the document is written,
+    so the document is streamed to the target rather than held in memory.
+    (With versions of pycairo lacking RecordingSurface, the document is
+    drawn straight into a temporary file, which is copied to the target.)
+
+    Subclasses must provide targetSurface(target).
+    """
+
+    @abc.abstractmethod
+    def targetSurface(self, target):
+        """
+        Create a surface of the output format and of self.dimensions,
+        writing to target (a path, or any object with a write() method).
+        """
 
-class SVG(OutputMethod):
-        
     @property
     def surface(self):
         if self.dimensions is None:
-            raise 'No dimensions loaded for SVG output.'
+            raise render_utils.RenderError('No dimensions loaded for %s output.' % \
+                self.__class__.__name__)
         if self._surface is None:
-            self._surface = cairo.SVGSurface(self._output, *self.dimensions)
+            if hasattr(cairo, 'RecordingSurface'):
+                self._surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+                    (0, 0) + tuple(self.dimensions))
+            else:
+                self._output = tempfile.TemporaryFile()
+                self._surface = self.targetSurface(self._output)
         return self._surface
+
+    def writeToFile(self, target):
+        if self._output is None:
+            surface = self.targetSurface(target)
+            context = cairo.Context(surface)
+            context.set_source_surface(self.surface, 0, 0)
+            context.paint()
+            surface.finish()
+            return target
+        self.surface.finish()
+        self._output.seek(0)
+        if isinstance(target, basestring):
+            fh = open(target, 'wb')
+            try:
+                shutil.copyfileobj(self._output, fh)
+            finally:
+                fh.close()
+        else:
+            shutil.copyfileobj(self._output, target)
+        return target
+
+class SVG(VectorOutputMethod):
+
+    def targetSurface(self, target):
+        return cairo.SVGSurface(target, *self.dimensions)
    
-class PDF(OutputMethod):
+class PDF(VectorOutputMethod):
 
-    @property
-    def surface(self):
-        if self.dimensions is None:
-            raise render_utils.RenderError('No dimensions loaded for PDF output.')
-        if self._surface is None:
-            self._surface = cairo.PDFSurface(self._output, *self.dimensions)
-        return self._surface
+    def targetSurface(self, target):
+        return cairo.PDFSurface(target, *self.dimensions)
@@ -37,6 +37,13 @@ class VerticalBarGraph(graph.Graph):
         self.y_title = ''
         
     def render(self, output_file):
+        """
+        Render the graph to output_file: a path, or any object with a
+        write() method (such as a file or an HttpResponse), which the
+        output is streamed to.
+        """
+        self.bindFonts()
+        self.prefetchLabels(self.title, self.x_title, self.y_title)
         # create layers
         if self.layers.scheme['background']['enabled']:
             self.layers.new('background', layers.Background())
@@ -50,16 +57,20 @@ class VerticalBarGraph(graph.Graph):
         
         self.__decorateAxes(x_axis, y_axis)
 
-        for i, category in enumerate(x_axis.categories):
+        positions = x_axis.pointsOfValues(xrange(len(x_axis.categories)))
+        for category, position in zip(x_axis.categories, positions):
             self.layers.new(
                 'set_' + ''.join(str(category.title).split()), 
                 self.Set(category, x_axis, y_axis), 
-                x_axis.positionOfValue(i)
+                position
             )
 
         # render and output
-        self.layers.renderAll()
-        self.output_interface.writeToFile(output_file)
+        try:
+            self.layers.renderAll()
+            self.output_interface.writeToFile(output_file)
+        finally:
+            self.fonts.flush() # keep what was measured, even on failure
 
     def __generateBackground(self):
         return layers.Background()
@@ -98,12 +109,18 @@ class VerticalBarGraph(graph.Graph):
 
     class Set(layering.Layer):
 
+        parallel_safe = True
+
         def __init__(self, values, x_axis, y_axis):
             self.values = values
             self.y_axis = y_axis
             self.x_axis = x_axis
             self.zero_pos = self.y_axis.positionOfValue(0)[1]
 
+        def prepare(self):
+            self.x_axis.prepare()
+            self.y_axis.prepare()
+
         def dimensions(self):
             w = self.width - ((self.width / 100) * self.scheme['series-spacing'])
             return (w, 200)
@@ -121,20 +138,40 @@ class VerticalBarGraph(graph.Graph):
             series_factor = self.scheme['set-spacing'] * .01 # converts percent to decimal
             return self.x_axis.categoryWidth / (len(self.values) + series_factor)
 
-        def renderLayer(self):
+        def bars(self):
+            """
+            Get the x position and the top (value) position of each bar.
+            """
             offset = 0
             if len(self.values) > 1:
                 offset =  self.seriesGap / (len(self.values) - 1)
             cumulative_gap_width = self.seriesGap * (len(self.values) - 1) - offset
             position = self.position[0] + self.edgeSpacing - cumulative_gap_width, self.position[1]
 
-            for i, value in enumerate(self.values):
-                v_position = self.y_axis.positionOfValue(value)[1]
-
+            v_positions = self.y_axis.positionsOfValues(self.values)
+            bars = []
+            for i in xrange(len(v_positions)):
                 if i > 0:
                     x = position[0] + (i * (self.seriesGap + self.seriesWidth))
                 else:
                     x = position[0] + (i * self.seriesWidth)
+                bars.append((x, v_positions[i]))
+            return bars
+
+        def boundingBox(self):
+            bars = self.bars()
+            if not bars:
+                return None
+            left = min(x for x, y in bars)
+            right = max(x for x, y in bars) + self.seriesWidth
+            top = min(min(y for x, y in bars), self.zero_pos)
+            bottom = max(max(y for x, y in bars), self.zero_pos)
+            return (left, top, right - left, bottom - top)
+
+        def renderLayer(self):
+            bars = self.bars()
+            for i, value in enumerate(self.values):
+                x, v_position = bars[i]
 
                 self.context.rectangle(
                     x,
@@ -0,0 +1,382 @@
+# Copyright (c) 2007 by Kenneth Keiter <ken@kenkeiter.com>
+#
+# This file is part of django-graph.
+#
+# Django-graph is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Django-graph is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with django-graph.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import zlib
+import Queue
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+_writes = Queue.Queue() # (write, items) batches for the background writer
+_writer = None
+_writer_lock = threading.Lock()
+
+def backgroundWriter():
+    """
+    Get the daemon thread making the writes of background flushes (see
+    WriteBehindCache.flush), starting it on first use. One thread serves
+    every WriteBehindCache in the process.
+    """
+    global _writer
+    _writer_lock.acquire()
+    try:
+        if _writer is None or not _writer.isAlive():
+            _writer = threading.Thread(target=_writeBatches)
+            _writer.setDaemon(True)
+            _writer.start()
+        return _writer
+    finally:
+        _writer_lock.release()
+
+def _writeBatches():
+    while True:
+        write, items = _writes.get()
+        try:
+            write(items)
+        except Exception:
+            # only cached values are lost -- they'll be measured again
+            log.exception('Background cache write failed.')
+        finally:
+            _writes.task_done()
+
+def waitForWrites():
+    """
+    Block until every batch handed to the background writer is written.
+    """
+    _writes.join()
+
+def approximateSize(key, value):
+    """
+    Estimate the memory (in bytes) used by a cache entry, counting tuples
+    one level deep.
+    """
+    size = 0
+    for obj in (key, value):
+        size += sys.getsizeof(obj)
+        if isinstance(obj, tuple):
+            size += sum(sys.getsizeof(item) for item in obj)
+    return size
+
+class LRUCache(object):
+    """
+    LRUCache() is a least-recently-used cache bounded by a number of
+    entries and/or a number of bytes (as estimated by its sizeof function).
+    It counts hits, misses and evictions so it can be sized, and is safe
+    to share between threads.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=approximateSize):
+        """
+        Initialize the cache. A limit of None means unbounded.
+
+        Parameters:
+            max_entries = the maximum number of entries to hold
+            max_bytes = the maximum total size of the entries to hold
+            sizeof = a function of (key, value) returning an entry's size
+        """
+        self.lock = threading.RLock()
+        self.entries = OrderedDict() # key -> (value, size), oldest first
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            try:
+                value, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = (value, size) # now the most recent
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        size = self.sizeof(key, value)
+        self.lock.acquire()
+        try:
+            self.__discard(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return # would never fit
+            self.entries[key] = (value, size)
+            self.bytes += size
+            self.__evict()
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self.__discard(key)
+        finally:
+            self.lock.release()
+
+    def resize(self, max_entries=None, max_bytes=None):
+        """
+        Change the limits of the cache, evicting entries if needed.
+        """
+        self.lock.acquire()
+        try:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self.__evict()
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.bytes = 0
+        finally:
+            self.lock.release()
+
+    @property
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __discard(self, key):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+
+    def __evict(self):
+        while self.entries and (
+            (self.max_entries is not None and len(self.entries) > self.max_entries) or
+            (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return '<LRUCache %r>' % self.stats
+
+class WriteBehindCache(object):
+    """
+    WriteBehindCache() wraps a cache client (such as memcache.Client) and
+    buffers its writes, sending them in a single set_multi() (or set_many)
+    call when flush() is called or when max_pending writes have built up.
+    Reads check the pending writes before going to the client.
+    """
+
+    def __init__(self, client, max_pending=1000, background_min=50):
+        self.client = client
+        self.max_pending = max_pending
+        self.background_min = background_min
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.pending:
+                return self.pending[key]
+        finally:
+            self.lock.release()
+        return self.client.get(key)
+
+    def get_multi(self, keys):
+        """
+        Get many keys at once. Returns a dict of the keys that were found.
+        """
+        found = {}
+        self.lock.acquire()
+        try:
+            for key in keys:
+                if key in self.pending:
+                    found[key] = self.pending[key]
+        finally:
+            self.lock.release()
+        missing = [key for key in keys if key not in found]
+        if missing:
+            get_multi = getattr(self.client, 'get_multi', None) or \
+                getattr(self.client, 'get_many', None)
+            if get_multi is not None:
+                found.update(get_multi(missing))
+            else:
+                for key in missing:
+                    value = self.client.get(key)
+                    if value is not None:
+                        found[key] = value
+        return found
+
+    def set(self, key, value):
+        self.lock.acquire()
+        try:
+            self.pending[key] = value
+            full = len(self.pending) >= self.max_pending
+        finally:
+            self.lock.release()
+        if full:
+            self.flush()
+
+    def flush(self, background=False):
+        """
+        Write out every pending write. If background is True, the writes
+        are handed to the process's background writer thread (see
+        backgroundWriter), unless there are fewer than background_min of
+        them -- a batch that small is written straight away.
+        """
+        self.lock.acquire()
+        try:
+            pending, self.pending = self.pending, {}
+        finally:
+            self.lock.release()
+        if not pending:
+            return
+        if background and len(pending) >= self.background_min:
+            backgroundWriter()
+            _writes.put((self.__write, pending))
+            return
+        self.__write(pending)
+
+    def __write(self, items):
+        set_multi = getattr(self.client, 'set_multi', None) or \
+            getattr(self.client, 'set_many', None)
+        if set_multi is not None:
+            set_multi(items)
+        else:
+            for key, value in items.iteritems():
+                self.client.set(key, value)
+
+class LocalCache(object):
+    """
+    LocalCache() is a dict-backed stand-in for a cache client such as
+    memcache.Client, for use without a cache server (offline, or in tests).
+    Like memcached, it refuses values larger than max_item_size bytes.
+    """
+
+    def __init__(self, max_item_size=1024 * 1024):
+        self.max_item_size = max_item_size
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def get_multi(self, keys):
+        data = self.data
+        return dict((key, data[key]) for key in keys if key in data)
+
+    def set(self, key, value):
+        if self.max_item_size is not None and isinstance(value, str) and \
+            len(value) > self.max_item_size:
+            return False
+        self.lock.acquire()
+        try:
+            self.data[key] = value
+        finally:
+            self.lock.release()
+        return True
+
+    def set_multi(self, mapping):
+        """
+        Set many keys at once. Returns a list of the keys that failed.
+        """
+        return [key for key, value in mapping.iteritems() \
+            if not self.set(key, value)]
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self.data.pop(key, None)
+        finally:
+            self.lock.release()
+
+# Blobs -----------------------------------------------------------------------
+#
+# Values larger than a cache's item limit (1 MB by default for memcached) are
+# stored compressed and split into chunks, with a small manifest under the
+# blob's own key. Chunk keys include part of the checksum, so a blob that is
+# rewritten with new contents never mixes chunks from the old one, and the
+# manifest is written last, so readers never see a manifest without chunks.
+
+BLOB_CHUNK_SIZE = 900 * 1024
+
+def setBlob(client, key, data, chunk_size=BLOB_CHUNK_SIZE, level=6):
+    """
+    Store a (possibly large) string in a cache as compressed chunks.
+    Returns True if every chunk and the manifest were stored.
+    """
+    checksum = hashlib.sha1(data).hexdigest()
+    packed = zlib.compress(data, level)
+    chunks = {}
+    for offset in xrange(0, len(packed), chunk_size):
+        chunks['%s.%s.%d' % (key, checksum[:12], len(chunks))] = \
+            packed[offset:offset + chunk_size]
+    set_multi = getattr(client, 'set_multi', None) or \
+        getattr(client, 'set_many', None)
+    if set_multi is not None:
+        if set_multi(chunks):
+            return False # some keys failed
+    else:
+        for chunk_key, chunk in chunks.iteritems():
+            if client.set(chunk_key, chunk) is False:
+                return False
+    manifest = {
+        'chunks': len(chunks),
+        'size': len(data),
+        'sha1': checksum,
+    }
+    return client.set(key, manifest) is not False
+
+def getBlob(client, key):
+    """
+    Get a string stored by setBlob(). Returns None if the blob is missing,
+    incomplete, or fails its checksum.
+    """
+    manifest = client.get(key)
+    if not isinstance(manifest, dict):
+        return None
+    try:
+        checksum = manifest['sha1']
+        keys = ['%s.%s.%d' % (key, checksum[:12], i) \
+            for i in xrange(manifest['chunks'])]
+        get_multi = getattr(client, 'get_multi', None) or \
+            getattr(client, 'get_many', None)
+        if get_multi is not None:
+            found = get_multi(keys)
+        else:
+            found = dict((k, client.get(k)) for k in keys)
+        data = zlib.decompress(''.join([found[k] for k in keys]))
+    except (KeyError, TypeError, zlib.error):
+        return None
+    if len(data) != manifest['size'] or \
+        hashlib.sha1(data).hexdigest() != checksum:
+        return None
+    return data
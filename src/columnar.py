@@ -0,0 +1,214 @@
+# Copyright (c) 2007 by Kenneth Keiter <ken@kenkeiter.com>
+#
+# This file is part of django-graph.
+#
+# Django-graph is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Django-graph is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with django-graph.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def titleTypecode(title):
+    """
+    Determine the array typecode able to hold a category title. Returns
+    'l' for integers, 'd' for floats and None for anything else (strings,
+    dates, etc.), which must be kept in a plain list.
+    """
+    if isinstance(title, bool):
+        return None
+    if isinstance(title, (int, long)):
+        return 'l'
+    if isinstance(title, float):
+        return 'd'
+    return None
+
+def asValueArray(values):
+    """
+    Convert a sequence of values (an array.array, NumPy array or any
+    iterable) to an array of doubles. Arrays are converted in C rather
+    than element by element.
+    """
+    if isinstance(values, array):
+        if values.typecode == 'd':
+            return values
+        return array('d', values)
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return array('d', numpy.ascontiguousarray(values, 'd').tostring())
+    return array('d', values)
+
+def asTitleSequence(titles):
+    """
+    Convert a sequence of titles to an array if they are all integers or
+    all floats, or to a list otherwise.
+    """
+    if isinstance(titles, array):
+        if titles.typecode in 'fd':
+            return array('d', titles)
+        if titles.typecode in 'cu':
+            return list(titles)
+        return array('l', titles)
+    if numpy is not None and isinstance(titles, numpy.ndarray):
+        if titles.dtype.kind in 'iu':
+            return array('l', numpy.ascontiguousarray(titles, numpy.int_).tostring())
+        if titles.dtype.kind == 'f':
+            return array('d', numpy.ascontiguousarray(titles, 'd').tostring())
+        return titles.tolist()
+    if isinstance(titles, xrange):
+        return array('l', titles)
+    return list(titles)
+
+def bufferToArray(data, typecode='d'):
+    """
+    Read the raw contents of any object supporting the buffer protocol
+    into an array of doubles. The buffer is interpreted as packed values
+    of the given array typecode.
+    """
+    try:
+        raw = memoryview(data).tobytes()
+    except TypeError:
+        raw = str(buffer(data)) # old-style buffer
+    values = array(typecode)
+    values.fromstring(raw)
+    return asValueArray(values)
+
+class ColumnStore(object):
+    """
+    ColumnStore() keeps the points of a columnar Series in two parallel
+    buffers -- one of titles and one of values -- along with a hash index
+    mapping each title to its slot. Numeric titles are kept in an array,
+    and values are always kept in an array of doubles.
+    """
+
+    def __init__(self):
+        self.titles = None
+        self.values = array('d')
+        self.extra = {} # slot -> further values appended under a title
+        self.slots = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def slotOf(self, title):
+        """
+        Get the slot holding the given title. Returns None if the title
+        is not in the store.
+        """
+        return self.slots.get(title)
+
+    def valuesAt(self, slot):
+        """
+        Get every value stored under a slot as a list.
+        """
+        if slot in self.extra:
+            return [self.values[slot]] + self.extra[slot]
+        return [self.values[slot]]
+
+    def titleAt(self, slot):
+        return self.titles[slot]
+
+    def __addTitle(self, title, position=None):
+        if self.titles is None:
+            typecode = titleTypecode(title)
+            if typecode is None:
+                self.titles = []
+            else:
+                self.titles = array(typecode)
+        elif isinstance(self.titles, array) and \
+            titleTypecode(title) != self.titles.typecode:
+            # mixed titles -- fall back to a list
+            self.titles = list(self.titles)
+        if position is None:
+            self.titles.append(title)
+        else:
+            self.titles.insert(position, title)
+
+    def __addTitles(self, titles):
+        if self.titles is None:
+            if isinstance(titles, array):
+                self.titles = array(titles.typecode)
+            else:
+                self.titles = []
+        if isinstance(self.titles, array):
+            if isinstance(titles, array) and \
+                titles.typecode == self.titles.typecode:
+                self.titles.extend(titles)
+                return
+            self.titles = list(self.titles)
+        self.titles.extend(titles)
+
+    def __reindex(self):
+        self.slots = dict((t, i) for i, t in enumerate(self.titles))
+
+    def append(self, title, value):
+        """
+        Append a point to the store. If the title already exists, the value
+        is kept alongside the existing value(s) for that title.
+        """
+        slot = self.slots.get(title)
+        if slot is None:
+            self.values.append(value)
+            self.__addTitle(title)
+            self.slots[title] = len(self.values) - 1
+        else:
+            self.extra.setdefault(slot, []).append(float(value))
+
+    def extend(self, titles, values):
+        """
+        Append parallel sequences of titles and values in bulk. Titles and
+        values may be array.array objects, NumPy arrays or any sequence.
+        Falls back to appending point by point if a title repeats.
+        """
+        titles = asTitleSequence(titles)
+        values = asValueArray(values)
+        if len(titles) != len(values):
+            raise ValueError('Titles and values must be of the same length.')
+        start = len(self.values)
+        new_slots = dict(izip(titles, xrange(start, start + len(values))))
+        if len(new_slots) != len(values) or \
+            new_slots.viewkeys() & self.slots.viewkeys():
+            for title, value in izip(titles, values):
+                self.append(title, value)
+            return
+        self.values.extend(values)
+        self.__addTitles(titles)
+        self.slots.update(new_slots)
+
+    def insert(self, position, title, value):
+        """
+        Insert a new point at the given position, shifting the slots of
+        the points that follow it.
+        """
+        if position < 0:
+            position += len(self.values)
+        position = min(max(position, 0), len(self.values)) # list semantics
+        self.values.insert(position, value)
+        self.__addTitle(title, position)
+        self.extra = dict(((s + 1 if s >= position else s), v) \
+            for s, v in self.extra.iteritems())
+        self.__reindex()
+
+    def remove(self, slot):
+        """
+        Remove the point in the given slot.
+        """
+        del self.values[slot]
+        del self.titles[slot]
+        self.extra.pop(slot, None)
+        self.extra = dict(((s - 1 if s > slot else s), v) \
+            for s, v in self.extra.iteritems())
+        self.__reindex()
@@ -0,0 +1,155 @@
+# Copyright (c) 2007 by Kenneth Keiter <ken@kenkeiter.com>
+#
+# This file is part of django-graph.
+#
+# Django-graph is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Django-graph is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with django-graph.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Decimation reduces a line's points to roughly as many as there are pixels
+to draw them in. Both methods below pick a subset of the original points
+(rather than averaging them), so peaks and troughs survive. Both split the
+points into buckets by position, so points must be sorted by x: decimate()
+leaves lines whose points aren't sorted as they are.
+"""
+
+from __future__ import division
+import render_utils
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def lttb(xs, ys, threshold):
+    """
+    Largest-triangle-three-buckets. Splits the points into threshold - 2
+    buckets and keeps the point from each bucket forming the largest
+    triangle with the previously kept point and the average of the next
+    bucket. The first and last points are always kept. Returns a list of
+    the indices to keep.
+    """
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return range(n)
+    if numpy is not None:
+        xs = numpy.asarray(xs, 'd')
+        ys = numpy.asarray(ys, 'd')
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    kept = [0]
+    for i in xrange(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = xs[a], ys[a]
+        if numpy is not None:
+            avg_x = xs[avg_start:avg_end].mean()
+            avg_y = ys[avg_start:avg_end].mean()
+            areas = numpy.abs((ax - avg_x) * (ys[start:end] - ay) - \
+                (ax - xs[start:end]) * (avg_y - ay))
+            a = start + int(areas.argmax())
+        else:
+            count = avg_end - avg_start
+            avg_x = sum(xs[avg_start:avg_end]) / count
+            avg_y = sum(ys[avg_start:avg_end]) / count
+            max_area = -1
+            for j in xrange(start, end):
+                area = abs((ax - avg_x) * (ys[j] - ay) - \
+                    (ax - xs[j]) * (avg_y - ay))
+                if area > max_area:
+                    max_area = area
+                    a = j
+        kept.append(a)
+    kept.append(n - 1)
+    return kept
+
+def minMax(xs, ys, columns):
+    """
+    Per-column min/max. Splits the x range into the given number of
+    columns (usually one per pixel) and keeps the first, last, lowest
+    and highest point of each. Returns a sorted list of the indices to
+    keep.
+    """
+    n = len(xs)
+    if n <= columns * 4 or columns < 1:
+        return range(n)
+    span = xs[n - 1] - xs[0]
+    if span <= 0:
+        return range(n)
+    scale = columns / span
+    if numpy is not None:
+        xs = numpy.asarray(xs, 'd')
+        ys = numpy.asarray(ys, 'd')
+        column = numpy.minimum(((xs - xs[0]) * scale).astype(int), \
+            columns - 1)
+        starts = numpy.concatenate(([0], \
+            numpy.flatnonzero(numpy.diff(column)) + 1))
+        ends = numpy.concatenate((starts[1:], [n])) - 1
+        # within each column, sorting by y puts the min first, max last
+        order = numpy.lexsort((ys, column))
+        kept = numpy.concatenate((starts, ends, order[starts], order[ends]))
+        return numpy.unique(kept).tolist()
+    kept = set()
+    x0 = xs[0]
+    current = None
+    for i in xrange(n):
+        c = min(int((xs[i] - x0) * scale), columns - 1)
+        if c != current:
+            if current is not None:
+                kept.update((first, i - 1, low, high))
+            current, first, low, high = c, i, i, i
+        elif ys[i] < ys[low]:
+            low = i
+        elif ys[i] > ys[high]:
+            high = i
+    kept.update((first, n - 1, low, high))
+    return sorted(kept)
+
+def isSorted(xs):
+    """
+    Check that xs never decreases.
+    """
+    if numpy is not None:
+        return bool((numpy.diff(numpy.asarray(xs, 'd')) >= 0).all())
+    return all(xs[i] <= xs[i + 1] for i in xrange(len(xs) - 1))
+
+def decimate(xs, ys, scheme, pixels):
+    """
+    Decimate a line according to its decimation scheme, given the length
+    in pixels of the axis it's drawn along. Returns a tuple of (xs, ys),
+    which are the originals if no decimation was needed (or if the points
+    aren't sorted by x, since the line is drawn in the order given).
+
+    Scheme keys:
+        enabled = True or False
+        method = 'lttb' or 'min-max'
+        samples-per-pixel = how many points to keep per pixel ('lttb'),
+            or how many columns to use per pixel ('min-max')
+    """
+    if scheme is None or not scheme['enabled']:
+        return xs, ys
+    samples = max(int(pixels * scheme['samples-per-pixel']), 1)
+    if len(xs) <= samples or not isSorted(xs):
+        return xs, ys
+    if scheme['method'] == 'lttb':
+        kept = lttb(xs, ys, samples)
+    elif scheme['method'] == 'min-max':
+        kept = minMax(xs, ys, samples)
+    else:
+        raise render_utils.RenderError('Unknown decimation method: %s' % \
+            scheme['method'])
+    if len(kept) == len(xs):
+        return xs, ys
+    return [xs[i] for i in kept], [ys[i] for i in kept]
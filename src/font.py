@@ -20,7 +20,13 @@ import ctypes
 import os
 import cairo
 import math
+import threading
+import weakref
+import hashlib
+import mmap
 import settings
+from caching import LRUCache, WriteBehindCache, getBlob, setBlob
+from metrics_store import MetricsStore
 
 # FontBook --------------------------------------------------------------------
 
@@ -29,34 +35,60 @@ class FontBook(object):
     The FontBook class manages all faces and styles used by django-graph.
     """
 
-    def __init__(self, context, cache = None):
+    def __init__(self, context, cache = None, metrics_path = None, label_masks = False):
         """
-        Initialize the FontBook instance, freetype rendering engine, borg
-        FontStyle, and assorted variables.
+        Initialize the FontBook instance, freetype rendering engine, and
+        assorted variables, and make it the current FontBook of this thread
+        (see FontStyle).
 
         Parameters:
             context = a Cairo rendering context instance
             cache = an acceptable object implementing the cache interface
+            metrics_path = (optional) the path of an on-disk MetricsStore
+                to warm dimensions from and save them to. Defaults to
+                FONT_METRICS_PATH in settings.py, if set.
+            label_masks = if True, labels drawn on image surfaces are
+                rasterized once and then composited from registry.label_masks
+                (see FontFace.render)
 
         Useful Variables:
-            FontBook.styles = a list() of styles that have been imported into
-                the font book
+            FontBook.styles = a weakref.WeakSet of the styles bound to the
+                font book (styles are dropped once nothing else uses them)
             FootBook.built_in = a set() of fonts built into Cairo
 
         Notes:
-            The FontStyle object uses the so-called 'borg' pattern so that
-            every instance of FontStyle created already has a manager (the
-            FontBook instance) available -- keeping the oft-used FontStyle
-            class light.
+            New FontStyles are bound to the current FontBook of the thread
+            creating them, unless given one explicitly, so that graphs
+            created and rendered on different threads never share a book
+            (or a Cairo context). Graphs also rebind the styles in their
+            scheme to their own book when they render. This relies on each
+            graph having its own output (and so its own context), which
+            Graph ensures unless the same output is passed to two graphs.
         """
         # initialize engines and components
         self.context = context
-        self.engine = FreeTypeEngine(cache=cache)
+        self.engine = registry.getEngine()
         FontStyle.initManagement(self)
-        self.styles = []
+        self.styles = weakref.WeakSet()
         self.faces = {}
         self.built_in = ['sans', 'sans-serif', 'serif']
         self.cache = cache
+        if cache is not None:
+            # dimension writes are sent in one batch by flush()
+            self.dimension_cache = WriteBehindCache(cache,
+                getattr(settings, 'DIMENSION_CACHE_MAX_PENDING', 1000))
+        else:
+            self.dimension_cache = None
+        if metrics_path is None:
+            metrics_path = getattr(settings, 'FONT_METRICS_PATH', None)
+        if metrics_path is not None:
+            self.metrics_store = registry.getMetricsStore(metrics_path)
+        else:
+            self.metrics_store = None
+        if label_masks:
+            self.label_masks = registry.label_masks
+        else:
+            self.label_masks = None
 
     def initializeFace(self, face_name_or_path, style_settings=None):
         """
@@ -81,7 +113,7 @@ class FontBook(object):
             face = face_name_or_path # str -- FontFace will use toy API
             settings = style_settings
         else:
-            face = self.engine.loadFont(face_name_or_path) # TT API
+            face = registry.getFace(face_name_or_path, cache=self.cache) # TT API
             settings = {} # ignore settings for TT
 
         new_face = FontFace(
@@ -89,17 +121,275 @@ class FontBook(object):
             name=face_name_or_path,
             face=face,
             settings=style_settings,
-            cache = self.cache
+            cache = self.dimension_cache,
+            store = self.metrics_store,
+            masks = self.label_masks
         )
+        if self.metrics_store is not None:
+            registry.warmDimensions(new_face, self.metrics_store)
 
         self.faces[face_name_or_path] = new_face
         return new_face
 
     def registerStyle(self, style):
-        self.styles.append(style)
+        self.styles.add(style)
+
+    def flush(self, background = False):
+        """
+        Send dimensions measured since the last flush to the remote cache
+        in a single set_multi (or set_many) call, and to the metrics store
+        in a single transaction. Graphs call this at the end of render().
+
+        Parameters:
+            background = if True, write to the remote cache from the
+                process's background writer thread (see
+                caching.backgroundWriter)
+        """
+        if self.metrics_store is not None:
+            self.metrics_store.flush()
+        if self.dimension_cache is not None:
+            self.dimension_cache.flush(background)
+
+    def prefetch(self, labels):
+        """
+        Load the cached dimensions of many labels from the remote cache in
+        a single get_multi (or get_many) call, so that measuring them later
+        only has to compute the labels that are really missing.
+
+        Parameters:
+            labels = an iterable of (FontStyle, content, rotation) tuples
+        """
+        if self.dimension_cache is None:
+            return
+        wanted = {} # remote key -> (face, local key)
+        for style, content, rotation in labels:
+            face = style.ft_face
+            # only unrotated dimensions are cached (see FontFace.dimensions)
+            key = face.cacheKey(style.style['size'], content, 0)
+            if key not in face.dimension_cache:
+                wanted[face.remoteKey(key)] = (face, key)
+        if not wanted:
+            return
+        for remote_key, dims in self.dimension_cache.get_multi(wanted.keys()).iteritems():
+            if dims is not None:
+                face, key = wanted[remote_key]
+                face.dimension_cache.set(key, dims)
+
+# FontRegistry ----------------------------------------------------------------
+
+def maskSize(key, value):
+    """
+    The size in bytes of a label mask cached by FontFace (its pixels).
+    """
+    surface = value[0]
+    return surface.get_stride() * surface.get_height()
+
+
+class FontRegistry(object):
+    """
+    The FontRegistry holds the FreeTypeEngine and the FreeType faces loaded
+    by this process, so that every FontBook (one per Graph) shares them
+    rather than initializing FreeType and loading each font file again.
+    A single instance, registry, is created when this module is imported.
+    It is safe to use from multiple threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.engine = None
+        self.faces = {} # (absolute path, face index) -> Cairo font face
+        self.metrics = {} # (face key, size) -> GlyphMetrics
+        self.stores = {} # absolute path -> MetricsStore
+        self.warmed = set() # (store path, face digest) loaded from stores
+        self.digests = {} # absolute path -> sha1 of the font file
+        self.label_masks = LRUCache( # see FontFace.render
+            max_bytes=getattr(settings, 'LABEL_MASK_CACHE_BYTES', 8 * 1024 * 1024),
+            sizeof=maskSize
+        )
+        self.dimensions = LRUCache( # see FontFace.dimensions
+            max_entries=getattr(settings, 'DIMENSION_CACHE_ENTRIES', 50000),
+            max_bytes=getattr(settings, 'DIMENSION_CACHE_BYTES', 16 * 1024 * 1024)
+        )
+
+    def getEngine(self):
+        """
+        Get the shared FreeTypeEngine, initializing it on first use. The
+        engine holds no cache of its own: each graph's cache is passed to
+        getFace() with the font it's loading.
+
+        Returns:
+            An instance of FreeTypeEngine
+        """
+        self.lock.acquire()
+        try:
+            if self.engine is None:
+                self.engine = FreeTypeEngine()
+            return self.engine
+        finally:
+            self.lock.release()
+
+    def getFace(self, path, face_index = 0, cache = None):
+        """
+        Get the Cairo font face for a face of a font file, loading it with
+        the shared FreeTypeEngine the first time it's requested.
+
+        Parameters:
+            path = the path to the desired font file
+            face_index = the index of the face within the file
+            cache = an acceptable object implementing the cache interface,
+                used to load the font file if it isn't loaded yet
+
+        Returns:
+            Cairo font_face (see FreeTypeEngine.loadFont)
+        """
+        key = (os.path.abspath(path), face_index)
+        self.lock.acquire()
+        try:
+            if key not in self.faces:
+                self.faces[key] = self.getEngine().loadFont(
+                    path, face_index, cache=cache)
+            return self.faces[key]
+        finally:
+            self.lock.release()
+
+    def releaseFace(self, path, face_index = 0):
+        """
+        Forget a face loaded by getFace(). Its FreeType face and the memory
+        holding its font file are freed once nothing else refers to it.
+        """
+        self.lock.acquire()
+        try:
+            self.faces.pop((os.path.abspath(path), face_index), None)
+        finally:
+            self.lock.release()
+
+    def getMetricsStore(self, path):
+        """
+        Get the shared MetricsStore for a path, opening it on first use.
+        """
+        path = os.path.abspath(path)
+        self.lock.acquire()
+        try:
+            if path not in self.stores:
+                self.stores[path] = MetricsStore(path)
+            return self.stores[path]
+        finally:
+            self.lock.release()
+
+    def warmDimensions(self, face, store):
+        """
+        Load every dimension stored for a FontFace into the shared
+        dimension cache. Each face is only loaded once per process.
+        """
+        digest = face.digest
+        self.lock.acquire()
+        try:
+            if (store.path, digest) in self.warmed:
+                return
+            self.warmed.add((store.path, digest))
+        finally:
+            self.lock.release()
+        face_key = face.key
+        for (size, rotation, content), dims in store.load(digest):
+            self.dimensions.set((face_key, size, rotation, content), dims)
+
+    def fileDigest(self, path):
+        """
+        Get the sha1 digest of a file's contents, reading it only once.
+        """
+        path = os.path.abspath(path)
+        self.lock.acquire()
+        try:
+            if path not in self.digests:
+                digest = hashlib.sha1()
+                fh = open(path, 'rb')
+                try:
+                    for block in iter(lambda: fh.read(1024 * 1024), ''):
+                        digest.update(block)
+                finally:
+                    fh.close()
+                self.digests[path] = digest.hexdigest()
+            return self.digests[path]
+        finally:
+            self.lock.release()
+
+    def getMetrics(self, face_key, size):
+        """
+        Get the shared GlyphMetrics table for a face (identified by
+        FontFace.key) at the given size.
+        """
+        self.lock.acquire()
+        try:
+            if (face_key, size) not in self.metrics:
+                self.metrics[(face_key, size)] = GlyphMetrics(size)
+            return self.metrics[(face_key, size)]
+        finally:
+            self.lock.release()
+
+# GlyphMetrics ----------------------------------------------------------------
+
+class GlyphMetrics(object):
+    """
+    The GlyphMetrics class holds the advance and ink extents of every glyph
+    of a face at one size. Each character is measured with Cairo only the
+    first time it's seen; strings are then measured in pure Python by
+    laying their glyphs out end to end -- which is exactly what Cairo's
+    toy text API does (it applies no kerning).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.glyphs = {} # char -> (x_advance, x_bearing, y_bearing, w, h)
+
+    def measure(self, face, content):
+        """
+        Determine the ink width and height of content.
+
+        Parameters:
+            face = the FontFace to measure any unknown characters with
+            content = the content to measure (str or unicode)
+
+        Returns:
+            A tuple in the format (width, height)
+        """
+        if isinstance(content, str):
+            content = content.decode('utf-8', 'replace')
+        missing = [c for c in set(content) if c not in self.glyphs]
+        if missing:
+            face.measureGlyphs(self.size, missing, self.glyphs)
+        glyphs = self.glyphs
+        pen = 0
+        left = top = right = bottom = None
+        for c in content:
+            x_advance, x_bearing, y_bearing, w, h = glyphs[c]
+            if w or h: # blank glyphs (spaces) have no ink
+                if left is None:
+                    left, right = pen + x_bearing, pen + x_bearing + w
+                    top, bottom = y_bearing, y_bearing + h
+                else:
+                    left = min(left, pen + x_bearing)
+                    right = max(right, pen + x_bearing + w)
+                    top = min(top, y_bearing)
+                    bottom = max(bottom, y_bearing + h)
+            pen += x_advance
+        if left is None:
+            return 0, 0
+        return right - left, bottom - top
 
 # FreeTypeEngine --------------------------------------------------------------
 
+def fontFileKey(path):
+    """
+    The cache key of a font file's blob (see caching.setBlob): an md5 of
+    the file's absolute path, so that a file has one key whichever
+    working directory it's loaded from, and the key is the same in every
+    process sharing the cache.
+    """
+    path = os.path.abspath(path)
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return 'djangographs.fonts.files.%s' % hashlib.md5(path).hexdigest()
+
 class FreeTypeEngine(object):
     """
     The FreeTypeEngine object provides an interface to the FreeType library
@@ -116,12 +406,13 @@ class FreeTypeEngine(object):
             ('base', ctypes.c_void_p),
         ]
 
-    def __init__(self, cache = None):
-        """
-        Initializes the FreeType font engine.
+    DESTROY_FUNC = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
 
-        Parameters:
-            cache = an acceptable instance of a caching object
+    def __init__(self):
+        """
+        Initializes the FreeType font engine. The engine is shared by every
+        FontBook (see FontRegistry), so caches are passed to loadFont()
+        rather than kept by the engine.
 
         Raises:
             render_utils.RenderError if unable to init engine or paths to libs are bad.
@@ -131,8 +422,11 @@ class FreeTypeEngine(object):
             install time (since the libaries are almost never in a common
             place, *nix's "locate" command is used by setup.py)
         """
-        self.cache = cache # set cache regardless of value
-        self.loadedFontBuffers = [] # prevent GC by holding ptrs here.
+        # reentrant: Cairo calls __releaseFace whenever a font face is
+        # freed, which may be while this thread already holds the lock
+        self.lock = threading.RLock()
+        self.fontBuffers = {} # absolute path -> FontBuffer
+        self.faceBuffers = {} # FT_Face address -> FontBuffer
         try:
             self.freetype_dl = ctypes.CDLL(settings.FREETYPE_LIB_PATH)
             self.cairo_dl = ctypes.CDLL(settings.CAIRO_LIB_PATH)
@@ -145,59 +439,113 @@ class FreeTypeEngine(object):
         except:
             raise render_utils.RenderError('Unable to initialize the FreeTypeEngine. \
                 Check lib paths in settings.py.')
+        # Called by Cairo when a font face it made from one of our FreeType
+        # faces is destroyed. Keep a reference so it's never collected.
+        self.__faceDestroyed = self.DESTROY_FUNC(self.__releaseFace)
+        self.__userDataKey = ctypes.create_string_buffer(1) # any unique address
 
-
-    @property
-    def cachingEnabled(self):
-        return self.cache is not None
-
-    def __loadFontIntoMemory(self, path):
+    def __loadFontIntoMemory(self, path, cache = None):
         """
-        Attempt to laod a font file into memory. If caching is enabled, attempt
-        to load the file from there first. If not, or the file is not found in
-        the cache, load the file into memory from physical storage and cache
-        it if caching is enabled.
+        Get the FontBuffer holding a font file, adding a reference to it.
+        Every face loaded from the same file shares one buffer. If a cache
+        is given, attempt to load the file from there first. If not, or
+        the file is not found in the cache, memory-map the file and cache
+        its contents if a cache was given. Files are cached as compressed,
+        chunked blobs (see caching.setBlob), so large fonts fit.
 
         Parameters:
             path = the path to the desired font
+            cache = (optional) an object implementing the cache interface
 
         Returns:
-            ctypes string_buffer or None
+            FontBuffer
 
         Raises:
-            render_utils.render_utils.RenderError if font does not exist.
+            render_utils.RenderError if font does not exist or can't be read.
         """
-        if self.cachingEnabled:
+        key = os.path.abspath(path)
+        self.lock.acquire()
+        try:
+            font_buffer = self.fontBuffers.get(key)
+            if font_buffer is not None:
+                font_buffer.refs += 1
+                return font_buffer
+        finally:
+            self.lock.release()
+        font_buffer = None
+        cache_key = fontFileKey(key)
+        if cache is not None:
             try:
-                font_data = self.cache.get('djangographs.fonts.files.%s' % str(path.__hash__()))
-                ptr = ctypes.create_string_buffer(font_data) # malloc equiv.
-                self.loadedFontBuffers.append(ptr)
-                return ptr
+                font_data = getBlob(cache, cache_key)
+                if font_data:
+                    font_buffer = FontBuffer(key, font_data)
             except:
                 pass
-        if not os.path.isfile(path) and not os.path.islink(path):
-            raise render_utils.RenderError('Supplied font file (%s) does not exist.' % path)
+        if font_buffer is None:
+            if not os.path.isfile(path) and not os.path.islink(path):
+                raise render_utils.RenderError('Supplied font file (%s) does not exist.' % path)
+            try:
+                font_buffer = FontBuffer(key)
+            except (IOError, OSError, ValueError, mmap.error):
+                raise render_utils.RenderError('Unable to read font file (%s).' % path)
+            if cache is not None:
+                try:
+                    setBlob(cache, cache_key, font_buffer.read())
+                except:
+                    pass # the font is loaded -- caching it is a bonus
+        self.lock.acquire()
         try:
-            font_data = open(path, 'rb').read()
-            if self.cachingEnabled:
-                self.cache.set('djangographs.fonts.files.%s' % str(path.__hash__()), font_data)
-            ptr = ctypes.create_string_buffer(font_data)
-            self.loadedFontBuffers.append(ptr)
-            return ptr
-        except:
-            return None
-
-
-    def loadFont(self, path=None, face_index=0):
+            # another thread may have loaded the same file meanwhile
+            font_buffer = self.fontBuffers.setdefault(key, font_buffer)
+            font_buffer.refs += 1
+            return font_buffer
+        finally:
+            self.lock.release()
+
+    def __releaseBuffer(self, font_buffer):
+        self.lock.acquire()
+        try:
+            font_buffer.refs -= 1
+            if font_buffer.refs > 0:
+                return
+            if self.fontBuffers.get(font_buffer.path) is font_buffer:
+                del self.fontBuffers[font_buffer.path]
+            font_buffer.close()
+        finally:
+            self.lock.release()
+
+    def __releaseFace(self, ft_face):
+        """
+        Cairo destroy callback: free a FreeType face once the Cairo font
+        face made from it is gone, and release the face's font buffer.
+        Cairo may call this on any thread, from inside any code that drops
+        the last reference to a font face -- including code holding the
+        registry's or the engine's lock (both are reentrant).
+
+        FreeType requires faces of a shared FT_Library to be created and
+        destroyed one at a time, so this holds the engine's lock, as
+        loadFont() does around FT_New_Memory_Face.
+        """
+        self.lock.acquire()
+        try:
+            self.freetype_dl.FT_Done_Face(ctypes.c_void_p(ft_face))
+            font_buffer = self.faceBuffers.pop(ft_face, None)
+            if font_buffer is not None:
+                self.__releaseBuffer(font_buffer)
+        finally:
+            self.lock.release()
+
+    def loadFont(self, path=None, face_index=0, cache=None):
         '''
         Attempt to load a FreeType font face into memory from either a file
-        or the cache (if enabled). If caching is enabled, the font will be
-        added if it is not already.
+        or a cache (if given). If a cache is given, the font will be added
+        to it if it is not already.
 
         Parameters:
             path = the path to the desired font file (.ttf, etc.)
             face_index = the index of the face if the file contains
                 multiple faces.
+            cache = (optional) an object implementing the cache interface
 
         Returns:
             Cairo font_face created by cairo.Context.get_font_face()
@@ -210,6 +558,11 @@ class FreeTypeEngine(object):
             in the resource fork instead of the data fork. DFONT is relatively
             proprietary, but I expect to have DFONT support available in the
             next major release.
+
+            The font file is memory-mapped (or copied once from the cache)
+            and shared by every face loaded from it. The FreeType face and
+            the file's memory are freed when the returned font face -- and
+            everything Cairo made from it -- is garbage collected.
         '''
 
         if path is None:
@@ -218,28 +571,85 @@ class FreeTypeEngine(object):
         # init values/types
         ft_face = ctypes.c_void_p() # destination face
         self.cairo_dl.cairo_ft_font_face_create_for_ft_face.restype = ctypes.c_void_p
+        self.cairo_dl.cairo_font_face_set_user_data.argtypes = [ctypes.c_void_p,
+            ctypes.c_void_p, ctypes.c_void_p, self.DESTROY_FUNC]
+        self.cairo_dl.cairo_set_font_face.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        self.cairo_dl.cairo_set_font_face.restype = None
+        self.cairo_dl.cairo_font_face_destroy.argtypes = [ctypes.c_void_p]
+        self.cairo_dl.cairo_font_face_destroy.restype = None
         create_status = -1 # default to fail
         surface = cairo.ImageSurface(cairo.FORMAT_A8, 0, 0)
         render_context = cairo.Context(surface)
         cairo_t = self.PycairoContext.from_address(id(render_context)).ctx
 
-        font_data = self.__loadFontIntoMemory(path)
+        font_buffer = self.__loadFontIntoMemory(path, cache)
 
-        create_status = self.freetype_dl.FT_New_Memory_Face(
-            self.freetype_lib,
-            font_data,
-            ctypes.c_long(len(font_data.raw)),
-            face_index,
-            ctypes.byref(ft_face)
-        )
-
-        if create_status != 0:
-            raise render_utils.RenderError('Failed to create a new FreeType face.')
-        cr_face = self.cairo_dl.cairo_ft_font_face_create_for_ft_face(ft_face)
-        if self.cairo_dl.cairo_set_font_face(cairo_t, cr_face) != 0:
+        # faces are created and destroyed (see __releaseFace) one at a
+        # time: FreeType doesn't allow it concurrently on one FT_Library
+        self.lock.acquire()
+        try:
+            create_status = self.freetype_dl.FT_New_Memory_Face(
+                self.freetype_lib,
+                ctypes.c_void_p(font_buffer.address),
+                ctypes.c_long(font_buffer.size),
+                ctypes.c_long(face_index),
+                ctypes.byref(ft_face)
+            )
+            if create_status != 0:
+                self.__releaseBuffer(font_buffer)
+                raise render_utils.RenderError('Failed to create a new FreeType face.')
+            self.faceBuffers[ft_face.value] = font_buffer
+        finally:
+            self.lock.release()
+        cr_face = self.cairo_dl.cairo_ft_font_face_create_for_ft_face(ft_face, 0)
+        if self.cairo_dl.cairo_font_face_set_user_data(cr_face,
+            self.__userDataKey, ft_face, self.__faceDestroyed) != 0:
+            self.cairo_dl.cairo_font_face_destroy(cr_face)
+            self.__releaseFace(ft_face.value)
             raise render_utils.RenderError('Unable to prepare font for face creation.')
+        self.cairo_dl.cairo_set_font_face(cairo_t, cr_face)
+        # the context holds its own reference now -- drop ours, so the face
+        # lives exactly as long as the pycairo object returned below.
+        self.cairo_dl.cairo_font_face_destroy(cr_face)
         return render_context.get_font_face()
 
+# FontBuffer ------------------------------------------------------------------
+
+class FontBuffer(object):
+    """
+    A font file held in memory for FreeType. Files on disk are memory-mapped
+    (copy-on-write, so the address is writable for ctypes; the pages are
+    never written and stay shared with the OS page cache), while files
+    loaded from the cache are copied into a single ctypes buffer. Used and
+    reference counted by FreeTypeEngine.
+    """
+
+    def __init__(self, path, data = None):
+        self.path = path
+        self.refs = 0
+        self.mapping = None
+        if data is None:
+            fh = open(path, 'rb')
+            try:
+                self.mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_COPY)
+            finally:
+                fh.close()
+            self.data = ctypes.c_char.from_buffer(self.mapping)
+            self.size = len(self.mapping)
+        else:
+            self.data = ctypes.create_string_buffer(data, len(data))
+            self.size = len(data)
+        self.address = ctypes.addressof(self.data)
+
+    def read(self):
+        return ctypes.string_at(self.address, self.size)
+
+    def close(self):
+        self.data = None
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
 # FontFace --------------------------------------------------------------------
 
 class FontFace(object):
@@ -248,7 +658,10 @@ class FontFace(object):
     (either built in, or from FreeType)
     """
 
-    def __init__(self, context, name, face, settings={}, cache=None):
+    MASK_SUBPIXELS = 4 # label masks are cached per 1/4 pixel offset
+
+    def __init__(self, context, name, face, settings={}, cache=None, store=None,
+        masks=None):
         """
         Initialize the FontFace instance.
 
@@ -260,36 +673,92 @@ class FontFace(object):
             settings = a dict with size, slant, and weight keys only
                 used if the font is built in.
             cache = an object implementing the cache interface
+            store = (optional) a MetricsStore to save dimensions to
+            masks = (optional) an LRUCache of rendered label masks
+
+        Notes:
+            Dimensions are kept in registry.dimensions, a bounded LRU cache
+            shared by every FontFace. Use registry.dimensions.resize() (or
+            DIMENSION_CACHE_ENTRIES and DIMENSION_CACHE_BYTES in
+            settings.py) to size it, and registry.dimensions.stats to see
+            how it's doing.
         """
         self.ft_face = face
         self.name = name
-        self.dimension_cache = {}
+        self.dimension_cache = registry.dimensions
         self.context = context
         self.settings = settings
         self.cache = cache
+        self.store = store
+        self.masks = masks
 
     @property
     def cachingEnabled(self):
         # self explanatory (said the comment)
         return self.cache is not None
 
-    def activate(self):
+    @property
+    def key(self):
+        """
+        A tuple identifying the face. Built-in faces are identified by
+        their name, slant and weight; FreeType faces by their path.
+        """
+        if isinstance(self.ft_face, basestring):
+            settings = self.settings or {}
+            return (self.name, settings.get('slant'), settings.get('weight'))
+        return (os.path.abspath(self.name),)
+
+    @property
+    def digest(self):
+        """
+        A string identifying the face by content rather than location: the
+        sha1 of the font file for FreeType faces (so a changed file isn't
+        matched with old metrics), or of the key for built-in faces.
+        """
+        if isinstance(self.ft_face, basestring):
+            return hashlib.sha1(repr(self.key)).hexdigest()
+        return registry.fileDigest(self.name)
+
+    def measureGlyphs(self, size, chars, table):
+        """
+        Measure individual characters with Cairo, adding them to a glyph
+        table (see GlyphMetrics).
+
+        Parameters:
+            size = size (in pt.) of the font (int/float)
+            chars = an iterable of single characters (unicode)
+            table = the dict to add the measurements to
+        """
+        self.context.save()
+        self.activate()
+        self.context.set_font_size(size)
+        for c in chars:
+            x_bearing, y_bearing, w, h, x_adv = self.context.text_extents(c)[:5]
+            table[c] = (x_adv, x_bearing, y_bearing, w, h)
+        self.context.restore()
+
+    def activate(self, context = None):
         """
         Set Cairo context's active font face to the font represented
         by this FontFace object.
+
+        Parameters:
+            context = (optional) the context to use instead of self.context
         """
+        if context is None:
+            context = self.context
         if isinstance(self.ft_face, basestring):
             # built-in fonts use select_font_face
-            self.context.select_font_face(
+            context.select_font_face(
                 self.ft_face,
                 self.settings['slant'],
                 self.settings['weight']
             )
         else:
             # non-built-in fonts use set_font_face
-            self.context.set_font_face(self.ft_face)
+            context.set_font_face(self.ft_face)
 
-    def __computeCacheKey(self, size, content, rotation):
+    def cacheKey(self, size, content, rotation):
         """
         Determine the key to use with the cache to refer to a specific
         permutation of the face.
@@ -300,15 +769,22 @@ class FontFace(object):
             rotation = the rotation in degrees (int/float)
 
         Returns:
-            string made up of concatenated characteristics
+            tuple in the format (face key, size, rotation, content)
         """
-        cache_addy = (
-            self.name.__hash__(),
-            size,
-            rotation,
-            content.__hash__()
-        )
-        return 'fn:%d,size:%d,rotation:%d.chsh:%d' % cache_addy
+        if isinstance(rotation, basestring):
+            rotation = render_utils.dehumanizeRotation(rotation)
+        if not isinstance(content, basestring):
+            content = str(content)
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        return (self.key, size, rotation, content)
+
+    def remoteKey(self, key):
+        """
+        Turn a cache key into a string usable with memcached (which limits
+        keys to 250 characters without spaces).
+        """
+        return 'djangographs.fonts.dimensions.' + hashlib.sha1(repr(key)).hexdigest()
 
     def __setCachedDimensions(self, size, content, rotation, dimensions):
         """
@@ -320,10 +796,12 @@ class FontFace(object):
             rotation = the rotation in degrees (int/float)
             dimensions = tuple or list of dims in format [width, height]
         """
-        key = self.__computeCacheKey(size, content, rotation)
-        self.dimension_cache[key.__hash__()] = dimensions
+        key = self.cacheKey(size, content, rotation)
+        self.dimension_cache.set(key, dimensions)
         if self.cachingEnabled:
-            self.cache.set('djangographs.fonts.dimensions.' + key, dimensions)
+            self.cache.set(self.remoteKey(key), dimensions)
+        if self.store is not None:
+            self.store.add(self.digest, key[1], key[2], key[3], dimensions)
 
     def __getCachedDimensions(self, size, content, rotation):
         """
@@ -338,18 +816,13 @@ class FontFace(object):
             A tuple or list of dims in form [width, height] or None if the
             key isn't available in the cache.
         """
-        key = self.__computeCacheKey(size, content, rotation)
-        try:
-            return self.dimension_cache[key.__hash__()]
-        except:
-            if self.cachingEnabled:
-                cache_result = self.cache.get('djangographs.fonts.dimensions.' + key)
-                # do a simple local cache (for key, hash is fast + unique)
-                if key not in self.dimension_cache:
-                    self.dimension_cache[key.__hash__()] = cache_result
-                return cache_result
-            else:
-                return None
+        key = self.cacheKey(size, content, rotation)
+        dims = self.dimension_cache.get(key)
+        if dims is None and self.cachingEnabled:
+            dims = self.cache.get(self.remoteKey(key))
+            if dims is not None:
+                self.dimension_cache.set(key, dims)
+        return dims
 
     def dimensions(self, size, content, rotation = 0):
         """
@@ -362,32 +835,67 @@ class FontFace(object):
             rotation = humanized (str) or dehumanized (int) rotation
 
         Returns:
-            A tuple in the format (width, height)
+            A tuple in the format (width, height). For rotated content,
+            these are the dimensions of the box bounding the rotated text.
 
         Notes:
             Dimensions are cached locally (or remotely, if enabled) as they
             are created. Determining dimensions is processor-intensive --
             caching improves performance measurably in most situations.
+            Only unrotated dimensions are cached: rotated ones are worked
+            out from them.
         """
         if isinstance(rotation, str):
             rotation = render_utils.dehumanizeRotation(rotation)
+        if not isinstance(content, basestring):
+            content = str(content)
         try:
-            dims = self.__getCachedDimensions(size, content, rotation)
+            dims = self.__getCachedDimensions(size, content, 0)
             if dims is None:
                 raise
-            return dims
         except:
-            self.context.save()
-            self.activate()
-            self.context.set_font_size(size)
-            w, h, x_adv, y_adv = self.context.text_extents(content)[2:]
-            if rotation != 0:
-                w = w * math.cos(math.radians(abs(rotation)))
-                h = h * math.sin(math.radians(abs(rotation)))
-            self.context.restore()
+            dims = registry.getMetrics(self.key, size).measure(self, content)
             # cache dimensions
-            self.__setCachedDimensions(size, content, rotation, (w, h))
-            return w, h
+            self.__setCachedDimensions(size, content, 0, dims)
+        if rotation != 0:
+            return render_utils.rotatedExtents(dims[0], dims[1], rotation)
+        return dims
+
+    def origin(self, size, position, align, content, rotation = 0):
+        """
+        Determine where render() starts the baseline of content.
+
+        Parameters:
+            see render()
+
+        Returns:
+            A tuple in the format (x, y, width, height)
+        """
+        x, y = position
+        width, height = self.dimensions(size, content, rotation)
+        align = align.lower()
+        if align == 'center':
+            x = x - (width / 2)
+        elif align == 'left':
+            pass # default align
+        elif align == 'right':
+            x = x - width
+        else:
+            raise render_utils.RenderError('Unknown align when attempting to render font.')
+        if rotation == 0:
+            y += height # measure fonts from the upper left-hand corner
+            return x, y, width, height
+        # put the upper left-hand corner of the box bounding the rotated
+        # text at x, y: find where the corners of the text (baseline at
+        # the origin) end up once rotated
+        w, h = self.dimensions(size, content)
+        angle = math.radians(rotation)
+        cos, sin = math.cos(angle), math.sin(angle)
+        corners = [(cx * cos - cy * sin, cx * sin + cy * cos) \
+            for cx in (0, w) for cy in (-h, 0)]
+        x -= min(c[0] for c in corners)
+        y -= min(c[1] for c in corners)
+        return x, y, width, height
 
     def render(self, size, position, align, content, rotation = 0):
         """
@@ -400,8 +908,9 @@ class FontFace(object):
             align = ('center', 'left', or 'right') positions are from the
                 upper-left-hand corner of the text block being rendered.
             content = string of content to be rendered on the canvas (str)
-            rotation = rotation of the text in deg./humanized around the
-                upper-left-hand corner of the text block (string/int/float)
+            rotation = rotation of the text in deg./humanized. Rotated text
+                is aligned and positioned by the box bounding it, like
+                unrotated text (string/int/float)
 
         Returns:
             The width and height of the rendered text in the format
@@ -409,21 +918,14 @@ class FontFace(object):
         """
         if isinstance(rotation, str):
             rotation = render_utils.dehumanizeRotation(rotation)
-        x, y = position
         self.context.save()
         self.activate()
         self.context.set_font_size(size)
-        width, height = self.dimensions(size, content, rotation)
-        y += height # measure fonts from the upper left-hand corner
-        align = align.lower()
-        if align == 'center':
-            x = x - (width / 2)
-        elif align == 'left':
-            pass # default align
-        elif align == 'right':
-            x = x - width
-        else:
-            raise render_utils.RenderError('Unknown align when attempting to render font.')
+        x, y, width, height = self.origin(size, position, align, content, rotation)
+        if self.masks is not None and self.__maskable():
+            self.__renderMask(size, content, rotation, x, y)
+            self.context.restore()
+            return (width, height)
         self.context.move_to(x, y)
         if rotation != 0:
             self.context.translate(x, y)
@@ -437,36 +939,107 @@ class FontFace(object):
         self.context.restore()
         return (width, height)
 
+    def __maskable(self):
+        """
+        Masks are only used on image surfaces, and only when the context
+        isn't scaled or rotated (which would blur them).
+        """
+        return isinstance(self.context.get_target(), cairo.ImageSurface) and \
+            tuple(self.context.get_matrix())[:4] == (1, 0, 0, 1)
+
+    def __renderMask(self, size, content, rotation, x, y):
+        """
+        Paint content (with its baseline starting at x, y) with the current
+        source, through a cached A8 mask of the text. The mask is rendered
+        at the position's subpixel offset, so the result matches show_text.
+        """
+        x, y = self.context.user_to_device(x, y)
+        steps = self.MASK_SUBPIXELS
+        left, top = int(math.floor(x)), int(math.floor(y))
+        sub_x = int(round((x - left) * steps))
+        sub_y = int(round((y - top) * steps))
+        key = self.cacheKey(size, content, rotation) + (sub_x, sub_y)
+        entry = self.masks.get(key)
+        if entry is None:
+            entry = self.__rasterize(size, key[3], rotation,
+                float(sub_x) / steps, float(sub_y) / steps)
+            self.masks.set(key, entry)
+        mask, mask_x, mask_y = entry
+        self.context.identity_matrix()
+        self.context.mask_surface(mask, left + mask_x, top + mask_y)
+
+    def __rasterize(self, size, content, rotation, offset_x, offset_y):
+        """
+        Render content to a new A8 surface just large enough to hold its
+        ink. Returns (surface, x, y) where x, y is the position of the
+        surface relative to the text's origin.
+        """
+        content = content.decode('utf-8')
+        scratch = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A8, 1, 1))
+        self.activate(scratch)
+        scratch.set_font_size(size)
+        x_bearing, y_bearing, w, h = scratch.text_extents(content)[:4]
+        angle = math.radians(rotation)
+        cos, sin = math.cos(angle), math.sin(angle)
+        corners = [(cx * cos - cy * sin, cx * sin + cy * cos) \
+            for cx in (x_bearing, x_bearing + w) \
+            for cy in (y_bearing, y_bearing + h)]
+        # a pixel of padding for antialiasing and the subpixel offset
+        left = int(math.floor(min(c[0] for c in corners))) - 1
+        top = int(math.floor(min(c[1] for c in corners))) - 1
+        right = int(math.ceil(max(c[0] for c in corners))) + 2
+        bottom = int(math.ceil(max(c[1] for c in corners))) + 2
+        surface = cairo.ImageSurface(cairo.FORMAT_A8, right - left, bottom - top)
+        cx = cairo.Context(surface)
+        cx.set_font_options(self.context.get_font_options())
+        self.activate(cx)
+        cx.set_font_size(size)
+        cx.translate(offset_x - left, offset_y - top)
+        cx.rotate(angle)
+        cx.move_to(0, 0)
+        cx.show_text(content)
+        surface.flush()
+        return surface, left, top
+
 # FontStyle --------------------------------------------------------------------
 
 class FontStyle(object):
     """
     The FontStyle class abstracts FontFace and provides a method
-    of encapsulating style changes in a mutable object. FontStyle
-    uses the Borg development pattern (in that every instance shares
-    a single FontBook).
+    of encapsulating style changes in a mutable object. Each FontStyle
+    is bound to a single FontBook: the one given when it's created, or
+    else the current FontBook of the thread creating it.
     """
-    __shared_book = None
+    __current = threading.local()
 
     @staticmethod
     def initManagement(book):
         """
-        Set the instance of FontBook to be used by all FontStyles.
-        This only needs to be called once and not on an instance
-        of FontStyle.
+        Set the instance of FontBook to be used by FontStyles created
+        (without an explicit book) on the calling thread from now on.
+        FontBook calls this when it's created.
 
         Parameters:
             book = an instance of FontBook
         """
-        FontStyle.__shared_book = book
+        FontStyle.__current.book = book
 
-    def __init__(self, **kwargs):
+    @staticmethod
+    def currentBook():
+        """
+        Get the current FontBook of the calling thread, or None.
+        """
+        return getattr(FontStyle.__current, 'book', None)
+
+    def __init__(self, book=None, **kwargs):
         """
         Initialize a new FontStyle object. Allows one to override
         the default styles upon creation via keyword args.
 
         Parameters:
-            *Note: All are keywords
+            book = (optional) the FontBook to bind the style to; defaults
+                to the current FontBook of the calling thread
+            *Note: All others are keywords
             face = the name (built-in) or path of a font face to use (str)
             size = size (in pt.) to use for this style
             slant = the slant (0 or 1) to be used for the font if built-in
@@ -474,17 +1047,32 @@ class FontStyle(object):
             align = alignment ('centered', 'left', 'right') to be used
                 for the style
         """
-        self.book = self.__shared_book # intantiate statics
-        if self.book is not None:
-            self.book.registerStyle(self) # let thyself be known
-        else:
-            raise 'No FontBook provided for new FontStyle object.'
+        if book is None:
+            book = self.currentBook()
+        if book is None:
+            raise render_utils.RenderError('No FontBook provided for new FontStyle object.')
+        self.book = book
+        self.book.registerStyle(self) # let thyself be known
         if hasattr(self, 'style'):
             self.update(kwargs)
         else:
             self.style = self.defaults
             self.update(kwargs)
 
+    def bind(self, book):
+        """
+        Bind the style to another FontBook (and so to its context), which
+        will be used to measure and render it from now on.
+
+        Parameters:
+            book = an instance of FontBook
+        """
+        if book is self.book:
+            return
+        self.book = book
+        self.book.registerStyle(self)
+        self.ft_face = self.book.initializeFace(self.style['face'], self.style)
+
     def update(self, options=None, **kwopts):
         """
         Update the font's options with a new dict or set of keyword args.
@@ -506,6 +1094,12 @@ class FontStyle(object):
             self.style.update(kwopts)
         self.ft_face = self.book.initializeFace(self.style['face'], self.style)
 
+    def frozen(self):
+        """
+        A hashable copy of the style's settings (see render_utils.freeze).
+        """
+        return ('FontStyle',) + tuple(sorted(self.style.items()))
+
     @property
     def defaults(self):
         return {
@@ -539,7 +1133,7 @@ class FontStyle(object):
                 rotation
             )
 
-    def render(self, content, position, rotation = 0):
+    def render(self, content, position, rotation = 0, batch = None):
         """
         Render the content using this font style on the canvas given a
         position and rotation.
@@ -549,7 +1143,11 @@ class FontStyle(object):
             position = (x,y) tuple or list of coordinates with origin in
                 upper-left-hand corner of canvas.
             rotation = humanized or unhumanized version of the rotation
+            batch = (optional) a TextBatch to add the content to, rather
+                than rendering it right away
         """
+        if batch is not None:
+            return batch.add(self, content, position, rotation)
         self.ft_face.render(
             self.style['size'],
             position,
@@ -557,3 +1155,61 @@ class FontStyle(object):
             content,
             rotation
         )
+
+# TextBatch -------------------------------------------------------------------
+
+class TextBatch(object):
+    """
+    The TextBatch class collects text to be rendered and draws it with one
+    show_glyphs() call per FontStyle, rather than setting up the context
+    and calling show_text() for every string. Output is identical: glyphs
+    are positioned exactly as FontFace.render() positions them, and drawn
+    with the context's current source when flush() is called.
+
+    Rotated text, text drawn through label masks (see FontFace.render) and
+    text drawn with pycairo versions lacking ScaledFont.text_to_glyphs()
+    is rendered immediately instead.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.runs = [] # (style, [(content, x, y), ...]) in order of first use
+        self.__index = {} # id(style) -> position in self.runs
+
+    def add(self, style, content, position, rotation = 0):
+        """
+        Add content to the batch (see FontStyle.render).
+        """
+        face = style.ft_face
+        if isinstance(rotation, str):
+            rotation = render_utils.dehumanizeRotation(rotation)
+        if rotation != 0 or face.masks is not None or \
+            not hasattr(cairo.ScaledFont, 'text_to_glyphs'):
+            return style.render(content, position, rotation)
+        if not isinstance(content, basestring):
+            content = str(content)
+        x, y = face.origin(style.style['size'], position,
+            style.style['align'], content, rotation)[:2]
+        if id(style) not in self.__index:
+            self.__index[id(style)] = len(self.runs)
+            self.runs.append((style, []))
+        self.runs[self.__index[id(style)]][1].append((content, x, y))
+
+    def flush(self):
+        """
+        Draw every run added since the last flush.
+        """
+        for style, run in self.runs:
+            self.context.save()
+            style.ft_face.activate(self.context)
+            self.context.set_font_size(style.style['size'])
+            scaled_font = self.context.get_scaled_font()
+            glyphs = []
+            for content, x, y in run:
+                glyphs.extend(scaled_font.text_to_glyphs(x, y, content, False))
+            self.context.show_glyphs(glyphs)
+            self.context.restore()
+        self.runs = []
+        self.__index = {}
+
+registry = FontRegistry()
@@ -18,9 +18,11 @@
 
 import render_utils
 import cairo
+from itertools import islice
 from layering import LayerManager
 from font import FontBook
 from backends.output import PNG
+from columnar import ColumnStore, asValueArray, bufferToArray, numpy
 
 class Graph(dict):
     """
@@ -28,29 +30,75 @@ class Graph(dict):
     It provides structual objects for graph data as well as
     """
 
-    def __init__(self, dimensions=None, output=PNG(), cache=None, **kwargs):
+    def __init__(self, dimensions=None, output=None, cache=None,
+        label_masks=False, cache_layers=False, parallel_layers=False, **kwargs):
         # initialize output
+        if output is None:
+            output = PNG() # one per graph -- never share a surface
         self.output_interface = output
         self.output_interface.dimensions = dimensions
         self.render_surface = output.surface
         self.render_cx = output.context
         # initialize functionality
         self.dimensions = dimensions
-        self.layers = LayerManager(self.render_cx, dimensions)
-        self.fonts = FontBook(self.render_cx, cache=cache)
+        # cache_layers: replay static layers (background, title, axes)
+        # rendered by earlier graphs rather than drawing them again
+        # parallel_layers: rasterize data layers on a thread pool (PNG only)
+        self.layers = LayerManager(self.render_cx, dimensions,
+            cache_static=cache_layers, parallel=parallel_layers)
+        # label_masks: reuse rasterized labels across graphs (PNG only)
+        self.fonts = FontBook(self.render_cx, cache=cache,
+            label_masks=label_masks)
         # initialize default values
         self.series = {}
         self.categories = []
+        self.category_index = {} # title -> Category (ordered by categories)
         # initialize usability aliases
         self.extend = self.layers.new
 
+    def bindFonts(self):
+        """
+        Bind every FontStyle in the graph's scheme to the graph's own
+        FontBook, so that it measures and renders on this graph's context
+        (even if the style was created for another graph, or on another
+        thread). Graphs call this at the start of render().
+        """
+        for style in self.layers.scheme.getFontStyles():
+            style.bind(self.fonts)
+
+    def prefetchLabels(self, title, x_title, y_title):
+        """
+        Fetch the cached dimensions of every label the graph measures while
+        laying itself out -- its title and the labels of both axes -- in a
+        single round trip to the remote cache (see FontBook.prefetch).
+        Graphs call this at the start of render(), after bindFonts().
+
+        Parameters:
+            title = the title of the graph
+            x_title = the title of the independent axis
+            y_title = the title of the dependent axis
+        """
+        from axis import axisLabels
+        scheme = self.layers.scheme
+        labels = []
+        if scheme['title']['enabled']:
+            labels.append((scheme['title']['font'], title, 0))
+        labels.extend(axisLabels(scheme['axes']['independent'], 'independent',
+            self.series, self.categories, x_title))
+        labels.extend(axisLabels(scheme['axes']['dependent'], 'dependent',
+            self.series, self.categories, y_title))
+        if labels:
+            self.fonts.prefetch(labels)
+
     def __importCategory(self, category):
-        if not category.title in [x.title for x in self.categories]:
-            self.categories.append(category)
-        else:
-            for globalcategory in self.categories:
-                if globalcategory.title == category.title:
-                    globalcategory.extend(category)
+        globalcategory = self.category_index.get(category.title)
+        if globalcategory is None:
+            # merge into a copy, never into the series' own category, so
+            # that the series (and its statistics) are left untouched
+            globalcategory = Category(category.title, category.series_title)
+            self.categories.append(globalcategory)
+            self.category_index[category.title] = globalcategory
+        globalcategory.extend(category)
 
     def importSeries(self, *args):
         """
@@ -67,36 +115,221 @@ class Graph(dict):
 
 class Series(list):
 
-    def __init__(self, title, dataset=None):
+    def __init__(self, title, dataset=None, columnar=False):
         """
         Series objects can be init'ed with a dataset so that
-        points can be added with just a dict.
+        points can be added with just a dict. If columnar is True, points
+        are kept in compact array buffers (see columnar.ColumnStore) rather
+        than as a list of Category objects; categories are then built on
+        the fly as the series is iterated. Columnar series only hold
+        numeric values, and the categories they return are read-only
+        snapshots: points are changed with append(), insert() and remove().
         """
         self.title = title
+        self.slots = {} # title -> index of its category
+        self.__stats = Statistics()
+        if columnar:
+            self.store = ColumnStore()
+        else:
+            self.store = None
         if isinstance(dataset, dict):
             for x in dataset:
                 self.append(x, dataset[x])
 
+    @property
+    def stats(self):
+        """
+        Statistics for the values in the series. These are kept up to date
+        as points are added through the Series, and rebuilt after a point
+        is removed. Values should only be changed through the Series:
+        changes made to a Category directly aren't tracked.
+        """
+        if self.__stats is None:
+            self.__stats = Statistics()
+            if self.columnar:
+                self.__stats.addMany(self.store.values)
+                for values in self.store.extra.itervalues():
+                    self.__stats.addMany(values)
+            else:
+                for category in list.__iter__(self):
+                    for value in category:
+                        self.__stats.add(value)
+        return self.__stats
+
+    @property
+    def columnar(self):
+        return self.store is not None
+
     @property
     def titles(self):
+        if self.columnar:
+            return list(self.store.titles or [])
         return [cat.title for cat in self]
 
+    def columns(self):
+        """
+        Get the series as parallel sequences of titles and values (the
+        first value of each category). Columnar series return their
+        buffers without copying them.
+        """
+        if self.columnar:
+            return self.store.titles or [], self.store.values
+        categories = list(list.__iter__(self))
+        return [c.title for c in categories], [c[0] for c in categories]
+
     def fromEquation(self, rng, func):
+        if numpy is not None and isinstance(rng, numpy.ndarray) and \
+            isinstance(func, numpy.ufunc):
+            # evaluate the whole range in one vectorized call
+            return self.fromArrays(rng, func(rng))
         for x in rng:
             self.append(x, func(x))
         return self
 
+    def fromArrays(self, titles, values):
+        """
+        Load parallel sequences of titles and values (NumPy arrays,
+        array.array objects or any other sequence) into the series in
+        bulk rather than point by point. The series is switched to
+        columnar storage if it isn't already.
+        """
+        values = asValueArray(values)
+        self.__makeColumnar()
+        self.store.extend(titles, values)
+        self.stats.addMany(values)
+        return self
+
+    def fromBuffer(self, data, typecode='d', titles=None):
+        """
+        Load values from any object supporting the buffer protocol, read
+        as packed values of the given array typecode. If titles isn't
+        provided, points are titled by their position in the buffer
+        (following any points already in the series).
+        """
+        values = bufferToArray(data, typecode)
+        if titles is None:
+            start = len(self)
+            titles = xrange(start, start + len(values))
+        return self.fromArrays(titles, values)
+
+    def fromQuerySet(self, queryset, x, y, aggregate=None, bucket=None, \
+        chunk_size=2000):
+        """
+        Load points from a Django QuerySet. Grouping and bucketing are done
+        by the database, and the results are streamed (via iterator()) into
+        the columnar store chunk_size rows at a time, so model instances
+        are never created.
+
+        Parameters:
+            queryset = the QuerySet to read from
+            x = the name of the field to use as category titles
+            y = the name of the field to use as values
+            aggregate = (optional) 'sum', 'avg', 'min', 'max', 'count' or
+                a Django aggregate class. Rows are grouped by x and y is
+                aggregated within each group.
+            bucket = (optional) truncate a date/time x to a 'year',
+                'month', 'day', 'hour', 'minute', etc. before grouping.
+                Aggregates with 'avg' unless an aggregate is given.
+            chunk_size = the number of rows to load at a time
+        """
+        from django.db import models
+        if bucket is not None:
+            from django.db.models.functions import Trunc
+            queryset = queryset.annotate(_graph_x=Trunc(x, bucket))
+            x = '_graph_x'
+            if aggregate is None:
+                aggregate = 'avg'
+        if aggregate is not None:
+            if isinstance(aggregate, basestring):
+                aggregates = {
+                    'sum': models.Sum,
+                    'avg': models.Avg,
+                    'min': models.Min,
+                    'max': models.Max,
+                    'count': models.Count,
+                }
+                try:
+                    aggregate = aggregates[aggregate.lower()]
+                except KeyError:
+                    raise ValueError('Unknown aggregate: %s' % aggregate)
+            queryset = queryset.values(x).annotate(_graph_y=aggregate(y))
+            y = '_graph_y'
+        rows = queryset.order_by(x).values_list(x, y).iterator()
+        self.__makeColumnar()
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            chunk = [row for row in chunk if row[1] is not None]
+            if not chunk:
+                continue
+            titles, values = zip(*chunk)
+            self.fromArrays(titles, values)
+        return self
+
+    def __makeColumnar(self):
+        """
+        Move the points of a list-backed series into a ColumnStore. The
+        store is filled before the series is changed, so a series holding
+        values that can't be kept in columns is left as it was.
+
+        Raises:
+            TypeError if a value isn't numeric (a string or None, say).
+        """
+        if self.columnar:
+            return
+        store = ColumnStore()
+        for category in list.__iter__(self):
+            for value in category:
+                store.append(category.title, value)
+        list.__delslice__(self, 0, list.__len__(self))
+        self.slots = {}
+        self.store = store
+
     def index(self, title):
-        for i, category in enumerate(self):
-            if category.title == title:
-                return i
-        raise KeyError('Unable to find index of given title.')
+        if self.columnar:
+            slot = self.store.slotOf(title)
+        else:
+            slot = self.slots.get(title)
+        if slot is None:
+            raise KeyError('Unable to find index of given title.')
+        return slot
+
+    def __reindex(self):
+        self.slots = dict((cat.title, i) for i, cat in \
+            enumerate(list.__iter__(self)))
+
+    def __category(self, slot):
+        """
+        Build a read-only snapshot of the Category at a slot of a columnar
+        series.
+        """
+        category = CategorySnapshot(self.store.titleAt(slot), self.title)
+        list.extend(category, self.store.valuesAt(slot))
+        return category
+
+    def __changed(self, operation):
+        """
+        Called before the list storage of a series is changed directly
+        (rather than through append(), insert() or remove()).
+        """
+        if self.columnar:
+            raise TypeError('%s is not supported by columnar series.' % \
+                operation)
+        self.__stats = None
 
     def append(self, title, value):
         """Allows a point to be appended to the series."""
-        if title not in self.titles:
+        if self.columnar:
+            self.store.append(title, value)
+            self.stats.add(value)
+            return
+        slot = self.slots.get(title)
+        if slot is None:
+            slot = self.slots[title] = list.__len__(self)
             list.append(self, Category(title, self.title))
-        self[self.index(title)].append(value)
+        list.__getitem__(self, slot).append(value)
+        self.stats.add(value)
 
     def extend(self, pairs):
         for title, value in pairs:
@@ -104,16 +337,188 @@ class Series(list):
 
     def insert(self, position, pair):
         title, value = pair
+        self.stats.add(value)
+        if self.columnar:
+            self.store.insert(position, title, value)
+            return
         new_category = Category(title, self.title)
         new_category.append(value)
         list.insert(self, position, new_category)
+        self.__reindex()
 
     def remove(self, title):
-        del self[self.index(title)]
+        self.__stats = None # extents can't be unwound; rebuild when needed
+        if self.columnar:
+            self.store.remove(self.index(title))
+            return
+        list.__delitem__(self, self.index(title))
+        self.__reindex()
 
-    def count(x):
+    def count(self, x):
         return len(filter(lambda cat: cat.title == x, self))
 
+    def pop(self, position=-1):
+        self.__changed('pop()')
+        category = list.pop(self, position)
+        self.__reindex()
+        return category
+
+    def sort(self, *args, **kwargs):
+        self.__changed('sort()')
+        list.sort(self, *args, **kwargs)
+        self.__reindex()
+
+    def reverse(self):
+        self.__changed('reverse()')
+        list.reverse(self)
+        self.__reindex()
+
+    def __setitem__(self, key, value):
+        self.__changed('Item assignment')
+        list.__setitem__(self, key, value)
+        self.__reindex()
+
+    def __delitem__(self, key):
+        self.__changed('Item deletion')
+        list.__delitem__(self, key)
+        self.__reindex()
+
+    def __setslice__(self, i, j, sequence):
+        self.__setitem__(slice(i, j), sequence)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
+    def __iadd__(self, sequence):
+        self.__changed('+=')
+        list.__iadd__(self, sequence)
+        self.__reindex()
+        return self
+
+    def __imul__(self, n):
+        self.__changed('*=')
+        list.__imul__(self, n)
+        self.__reindex()
+        return self
+
+    def __contains__(self, item):
+        if self.columnar:
+            return any(item == category for category in self)
+        return list.__contains__(self, item)
+
+    def __len__(self):
+        if self.columnar:
+            return len(self.store)
+        return list.__len__(self)
+
+    def __iter__(self):
+        if self.columnar:
+            return (self.__category(i) for i in xrange(len(self.store)))
+        return list.__iter__(self)
+
+    def __reversed__(self):
+        if self.columnar:
+            return (self.__category(i) for i in \
+                xrange(len(self.store) - 1, -1, -1))
+        return list.__reversed__(self)
+
+    def __getitem__(self, key):
+        if not self.columnar:
+            return list.__getitem__(self, key)
+        if isinstance(key, slice):
+            return [self.__category(i) for i in \
+                xrange(*key.indices(len(self.store)))]
+        if key < 0:
+            key += len(self.store)
+        if not 0 <= key < len(self.store):
+            raise IndexError('Series index out of range.')
+        return self.__category(key)
+
+    def __getslice__(self, i, j):
+        # list defines __getslice__, so py2 won't route slices to
+        # __getitem__ unless we do it ourselves.
+        return self.__getitem__(slice(i, j))
+
+    def __repr__(self):
+        return "<Series '%s': %r>" % (self.title, [x for x in self])
+
+
+class Statistics(object):
+    """
+    Running statistics for a set of values: count, sum, minimum, maximum,
+    and the extents of the positive and negative values (the largest
+    positive value and the smallest negative value, or 0 if there are
+    none). Strings are only counted, in strings, and None is skipped.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.positive_max = 0
+        self.negative_min = 0
+        self.strings = 0
+
+    def add(self, value):
+        if value is None:
+            return
+        if isinstance(value, basestring):
+            self.strings += 1
+            return
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        if value > self.positive_max:
+            self.positive_max = value
+        elif value < self.negative_min:
+            self.negative_min = value
+
+    def addMany(self, values):
+        """
+        Add a sequence of numeric values (such as an array) in one go.
+        """
+        if not len(values):
+            return
+        if numpy is not None:
+            values = numpy.asarray(values, 'd')
+            low, high, total = values.min(), values.max(), values.sum()
+        else:
+            low, high, total = min(values), max(values), sum(values)
+        self.merge(Statistics.fromExtents(len(values), total, low, high))
+
+    def merge(self, other):
+        """
+        Fold the statistics of another set of values into this one.
+        """
+        self.count += other.count
+        self.total += other.total
+        self.strings += other.strings
+        if other.minimum is not None and \
+            (self.minimum is None or other.minimum < self.minimum):
+            self.minimum = other.minimum
+        if other.maximum is not None and \
+            (self.maximum is None or other.maximum > self.maximum):
+            self.maximum = other.maximum
+        self.positive_max = max(self.positive_max, other.positive_max)
+        self.negative_min = min(self.negative_min, other.negative_min)
+
+    @staticmethod
+    def fromExtents(count, total, minimum, maximum):
+        stats = Statistics()
+        stats.count, stats.total = count, total
+        stats.minimum, stats.maximum = minimum, maximum
+        stats.positive_max = max(maximum, 0)
+        stats.negative_min = min(minimum, 0)
+        return stats
+
+    def __repr__(self):
+        return '<Statistics count=%d min=%r max=%r>' % \
+            (self.count, self.minimum, self.maximum)
+
 
 class Category(list):
     def __init__(self, title, series_title):
@@ -123,3 +528,18 @@ class Category(list):
 
     def __repr__(self):
         return "<Category '%s': %r>" % (self.title, [x for x in self])
+
+
+class CategorySnapshot(Category):
+    """
+    CategorySnapshot() is a Category built from the buffers of a columnar
+    Series. It's a copy, so it can't be changed: change the Series instead.
+    """
+
+    def __readOnly(self, *args, **kwargs):
+        raise TypeError('Categories of columnar series are read-only; '
+            'change the series instead.')
+
+    append = extend = insert = pop = remove = reverse = sort = __readOnly
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __readOnly
+    __iadd__ = __imul__ = __readOnly
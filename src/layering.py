@@ -16,13 +16,151 @@
 # along with django-graph.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division
+import math
+import threading
+import cairo
 import render_utils
+import settings
+from caching import LRUCache
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+def patternSize(key, entry):
+    """
+    The size in bytes of a cached layer: its pixels if it was rasterized,
+    or a nominal 64 kb for vector recordings.
+    """
+    surface = entry[0].get_surface()
+    if isinstance(surface, cairo.ImageSurface):
+        return surface.get_stride() * surface.get_height()
+    return 64 * 1024
+
+# Static layers rendered by every LayerManager created with cache_static,
+# as (Cairo pattern, lock) pairs (see LayerManager.renderStatic)
+static_layers = LRUCache(
+    max_bytes=getattr(settings, 'LAYER_CACHE_BYTES', 32 * 1024 * 1024),
+    sizeof=patternSize
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def renderPool():
+    """
+    Get the thread pool used to rasterize layers in parallel (see
+    LayerManager), creating it on first use. Its size is RENDER_THREADS
+    in settings.py, or the number of CPUs.
+    """
+    global _pool
+    _pool_lock.acquire()
+    try:
+        if _pool is None:
+            _pool = ThreadPool(getattr(settings, 'RENDER_THREADS', None) or cpu_count())
+        return _pool
+    finally:
+        _pool_lock.release()
+
+class SpatialGrid(object):
+    """
+    SpatialGrid() is a uniform grid index of boxes in the format (left,
+    top, right, bottom). Each item is listed in every cell its box covers,
+    except for items covering more than a quarter of the grid's area,
+    which are kept aside (so that a background doesn't fill every cell).
+    """
+
+    def __init__(self, width, height, cell_size = 64):
+        self.cell_size = cell_size
+        self.large_area = width * height / 4
+        self.cells = {} # (column, row) -> [(item, box), ...]
+        self.large = [] # [(item, box), ...]
+
+    def __cellRange(self, box):
+        size = self.cell_size
+        return (xrange(int(math.floor(box[0] / size)), int(math.floor(box[2] / size)) + 1),
+            xrange(int(math.floor(box[1] / size)), int(math.floor(box[3] / size)) + 1))
+
+    def insert(self, item, box):
+        if (box[2] - box[0]) * (box[3] - box[1]) > self.large_area:
+            self.large.append((item, box))
+            return
+        columns, rows = self.__cellRange(box)
+        for column in columns:
+            for row in rows:
+                self.cells.setdefault((column, row), []).append((item, box))
+
+    def query(self, box):
+        """
+        Get every item whose box intersects box.
+        """
+        found = {}
+        for item, item_box in self.large:
+            if render_utils.boxesIntersect(box, item_box):
+                found[id(item)] = item
+        columns, rows = self.__cellRange(box)
+        if len(columns) * len(rows) > len(self.cells):
+            cells = self.cells.itervalues() # the box covers most cells
+        else:
+            cells = (self.cells.get((c, r), ()) for c in columns for r in rows)
+        for cell in cells:
+            for item, item_box in cell:
+                if id(item) not in found and \
+                    render_utils.boxesIntersect(box, item_box):
+                    found[id(item)] = item
+        return found.values()
+
+    def pairs(self):
+        """
+        Get every pair of items whose boxes intersect, as a list of tuples.
+        """
+        found = {}
+        def check(a, b):
+            key = (min(id(a[0]), id(b[0])), max(id(a[0]), id(b[0])))
+            if key not in found and render_utils.boxesIntersect(a[1], b[1]):
+                found[key] = (a[0], b[0])
+        for i, large in enumerate(self.large):
+            for other in self.large[i + 1:]:
+                check(large, other)
+            for cell in self.cells.itervalues():
+                for other in cell:
+                    check(large, other)
+        for cell in self.cells.itervalues():
+            for i, a in enumerate(cell):
+                for b in cell[i + 1:]:
+                    check(a, b)
+        return found.values()
 
 class LayerManager(list):
-
-    def __init__(self, context, canvas_dimensions):
+    """
+    LayerManager() is the stack of a graph's layers, topmost first. Layers
+    are indexed by name, and their stack positions are kept as keys
+    relative to the top of the stack, so adding a layer (always on top)
+    never renumbers the others. Moving or destroying a layer only marks
+    the positions for a rebuild the next time one is needed.
+
+    If cache_static is True, static layers (see Layer) are rendered once
+    and replayed from layering.static_layers by later graphs that draw
+    the same thing.
+
+    Layer bounds (see Layer.positionalBounds) are kept in a SpatialGrid,
+    built when first queried and rebuilt after layers are added, removed
+    or repositioned (or after invalidateBounds() is called).
+
+    If parallel is True and the target is an image surface, layers marked
+    parallel_safe (see Layer) are rasterized on separate surfaces by a
+    pool of threads -- Cairo releases the GIL while it draws -- and then
+    composited in order.
+    """
+
+    def __init__(self, context, canvas_dimensions, cache_static = False,
+        parallel = False):
         self.context = context
         self.canvas_dimensions = canvas_dimensions
+        self.cache_static = cache_static
+        self.parallel = parallel
+        self.names = {} # layer name -> topmost layer with that name
+        self.__keys = {} # id(layer) -> stack position + self.__top
+        self.__top = 0
+        self.__grid = None # SpatialGrid of layer bounds
 
     def importBaseScheme(self, scheme):
         self.scheme = scheme
@@ -36,83 +174,260 @@ class LayerManager(list):
         if obj.__class__.__name__.lower() in self.scheme.keys():
             obj.scheme = self.scheme[obj.__class__.__name__.lower()]
         self.insert(0, obj)
+        self.names[layer_name] = obj
+        self.__grid = None
+        if self.__keys is not None:
+            self.__top -= 1
+            self.__keys[id(obj)] = self.__top
         return obj
 
     def getLayerByName(self, layer_name):
-        for layer in self:
-            if layer.name == layer_name:
-                return layer
-        return False
+        return self.names.get(layer_name, False)
 
     def hasLayer(self, layer_name):
-        if self.getLayerByName(layer_name) is not False:
-            return True
-        return False
+        return layer_name in self.names
 
     def getDimensions(self, layer_name):
         return self.getLayerByName(layer_name).dimensions()
 
+    def invalidateBounds(self):
+        """
+        Mark the spatial index of layer bounds as stale (e.g. after a
+        layer's dimensions change).
+        """
+        self.__grid = None
+
+    def __spatialGrid(self):
+        if self.__grid is None:
+            width, height = self.canvas_dimensions
+            grid = SpatialGrid(width, height,
+                getattr(settings, 'LAYER_GRID_CELL_SIZE', 64))
+            for layer in self:
+                grid.insert(layer, layer.positionalBounds())
+            self.__grid = grid
+        return self.__grid
+
+    def layersIntersecting(self, box):
+        """
+        Get the layers whose bounds intersect a box in the format (left,
+        top, right, bottom), topmost first.
+        """
+        layers = self.__spatialGrid().query(box)
+        layers.sort(key=self.getStackPosition)
+        return layers
+
+    def overlappingLayers(self):
+        """
+        Get every pair of layers whose bounds intersect, as a list of
+        tuples in the format (upper layer, lower layer).
+        """
+        pairs = []
+        for a, b in self.__spatialGrid().pairs():
+            if self.getStackPosition(a) > self.getStackPosition(b):
+                a, b = b, a
+            pairs.append((a, b))
+        return pairs
+
     def findLayersWithinBox(self, uppercorner, lowercorner):
-        box = (range(uppercorner[0], lowercorner[0]), \
-            range(uppercorner[1], lowercorner[1]))
-        for layer in self:
-            if any([(x in box[0]) for x in layer[0]]) and \
-                any([(x in box[1]) for x in layer[1]]):
-                yield layer
+        return self.layersIntersecting(tuple(uppercorner) + tuple(lowercorner))
 
     def isCollision(self, layer1_name, layer2_name):
         l1 = self.getLayerByName(layer1_name).positionalBounds()
         l2 = self.getLayerByName(layer2_name).positionalBounds()
-        if any([(x in l1[0]) for x in l2[0]]) and \
-            any([(x in l1[1]) for x in l2[1]]):
-            return True
+        return render_utils.boxesIntersect(l1, l2)
 
     def getStackPosition(self, layer):
-        return self.index(layer)
+        if self.__keys is None:
+            self.__top = 0
+            self.__keys = dict((id(item), i) for i, item in enumerate(self))
+        try:
+            return self.__keys[id(layer)] - self.__top
+        except KeyError:
+            raise ValueError('Layer %r is not managed by this LayerManager.' % layer)
 
     def getCurrentDepth(self):
         return len(self)
 
     def destroy(self, layer_name):
-        index = self.getStackPosition(self.getLayerByName(layer_name))
-        del self[index]
+        layer = self.getLayerByName(layer_name)
+        del self[self.getStackPosition(layer)]
+        self.__keys = None
+        self.__grid = None
+        del self.names[layer_name]
+        for other in self: # another layer may share the name
+            if other.name == layer_name:
+                self.names[layer_name] = other
+                break
+
+    def compositingPlan(self, layer, opacity):
+        """
+        Decide how to composite a layer. Layers are drawn straight onto the
+        target unless they need an offscreen group -- to apply an opacity
+        below 1, or because they're isolated (see Layer) -- in which case
+        the group is clipped to the layer's bounding box (if it has one),
+        so only that much surface is allocated.
+
+        Returns:
+            A tuple in the format (group, clip) where group is a bool and
+            clip is a box (x, y, width, height) in whole pixels, or None
+        """
+        if opacity < 1 or layer.isolated:
+            return True, self.clipBox(layer)
+        return False, None
+
+    def clipBox(self, layer):
+        """
+        Get a layer's bounding box rounded outwards to whole pixels, with a
+        pixel to spare for antialiasing, or None if it has none.
+        """
+        box = layer.boundingBox()
+        if box is None:
+            return None
+        x, y = math.floor(box[0]) - 1, math.floor(box[1]) - 1
+        return (x, y, math.ceil(box[0] + box[2]) + 1 - x,
+            math.ceil(box[1] + box[3]) + 1 - y)
 
     def renderAll(self):
-        self.reverse()
-        for layer in self:
+        plan = []
+        for layer in reversed(self):
             try:
-                if layer.scheme['enabled']:
-                    layer.render(layer.scheme['transparency'] * 0.01)
+                enabled = layer.scheme['enabled']
+                opacity = layer.scheme['transparency'] * 0.01
             except:
-                layer.render(1)
-        self.reverse() # return it back to normal
+                enabled, opacity = True, 1
+            if enabled:
+                plan.append((layer, opacity))
+        rasters = {} # id(layer) -> AsyncResult of self.rasterize()
+        if self.parallel and \
+            isinstance(self.context.get_target(), cairo.ImageSurface) and \
+            tuple(self.context.get_matrix()) == (1, 0, 0, 1, 0, 0):
+            pool = renderPool()
+            for layer, opacity in plan:
+                if layer.parallel_safe and \
+                    not (self.cache_static and layer.static):
+                    layer.prepare() # lazily cached state is filled in here
+                    rasters[id(layer)] = pool.apply_async(self.rasterize, (layer,))
+        for layer, opacity in plan:
+            if id(layer) in rasters:
+                surface, x, y = rasters[id(layer)].get()
+                self.context.save()
+                self.context.set_source_surface(surface, x, y)
+                self.context.paint_with_alpha(opacity)
+                self.context.restore()
+                continue
+            if self.cache_static and layer.static and \
+                self.renderStatic(layer, opacity):
+                continue
+            group, clip = self.compositingPlan(layer, opacity)
+            layer.render(opacity, group, clip)
+
+    def rasterize(self, layer):
+        """
+        Render a layer onto a new image surface covering its bounding box
+        (or the canvas), using a context of its own. Used from the render
+        pool's threads.
 
-    def moveToTop(self, layer):
+        Returns:
+            A tuple in the format (surface, x, y), where x, y is the
+            position of the surface on the canvas
+        """
+        width, height = self.canvas_dimensions
+        box = self.clipBox(layer)
+        if box is None:
+            box = (0, 0, width, height)
+        x, y = int(max(box[0], 0)), int(max(box[1], 0))
+        w = max(int(min(box[0] + box[2], width)) - x, 1)
+        h = max(int(min(box[1] + box[3], height)) - y, 1)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        context = cairo.Context(surface)
+        context.translate(-x, -y)
+        layer.context = context
+        try:
+            if hasattr(layer, 'initLayer') and callable(layer.initLayer):
+                layer.initLayer()
+            layer.renderLayer()
+        finally:
+            layer.context = self.context
+        surface.flush()
+        return surface, x, y
+
+    def staticKey(self, layer):
+        """
+        Get the key a static layer is cached under: its class, scheme,
+        position and cacheKey(), the canvas and the kind of output. Returns
+        None if the layer can't be cached.
+        """
+        content = layer.cacheKey()
+        if content is None:
+            return None
+        return (layer.__class__, render_utils.freeze(layer.scheme),
+            tuple(layer.position), content, tuple(self.canvas_dimensions),
+            self.context.get_target().__class__,
+            tuple(self.context.get_matrix()))
+
+    def renderStatic(self, layer, opacity):
+        """
+        Paint a static layer from the cache, rendering it into a group and
+        caching that first if needed. A group on an image surface is a
+        raster; on a vector surface it's a recording. Returns False if the
+        layer can't be cached.
+
+        Cached patterns are shared by graphs rendering on other threads,
+        and Cairo doesn't guard a source being read by several contexts at
+        once, so each pattern is only painted while holding its own lock.
+        """
+        key = self.staticKey(layer)
+        if key is None:
+            return False
+        entry = static_layers.get(key)
+        if entry is None:
+            if hasattr(layer, 'initLayer') and callable(layer.initLayer):
+                layer.initLayer()
+            self.context.save()
+            box = self.clipBox(layer)
+            if box is not None:
+                self.context.rectangle(*box)
+                self.context.clip()
+            self.context.push_group()
+            layer.renderLayer()
+            entry = (self.context.pop_group(), threading.Lock())
+            self.context.restore()
+            static_layers.set(key, entry)
+        pattern, lock = entry
+        lock.acquire()
+        try:
+            self.context.save()
+            self.context.set_source(pattern)
+            self.context.paint_with_alpha(opacity)
+            self.context.restore()
+        finally:
+            lock.release()
+        return True
+
+    def __move(self, layer, position):
         currentPos = layer.zIndex()
-        if currentPos != 0:
-            self.insert(0, layer)
-            del self[currentPos + 1]
+        position = min(max(position, 0), len(self) - 1)
+        if position != currentPos:
+            self.insert(position, self.pop(currentPos))
+            self.__keys = None
+
+    def moveToTop(self, layer):
+        self.__move(layer, 0)
 
     def moveToBottom(self, layer):
-        currentPos = layer.zIndex()
-        if currentPos != len(self):
-            self.append(layer)
-            del self[currentPos - 1]
+        self.__move(layer, len(self) - 1)
 
     def moveUp(self, layer):
-        currentPos = layer.zIndex()
-        if currentPos - 2 >= 0:
-            self.insert(currentPos - 2, layer)
-            del self[currentPos + 1]
+        self.__move(layer, layer.zIndex() - 1)
 
     def moveDown(self, layer):
-        ''' Work on this '''
-        currentPos = layer.zIndex()
-        if currentPos + 2 >= 0:
-            self.insert(currentPos + 2, layer)
-            del self[currentPos + 1]
+        self.__move(layer, layer.zIndex() + 1)
 
     def __getattr__(self, attr_name):
+        if attr_name.startswith('_') or 'names' not in self.__dict__:
+            # private and special names are never layers (and looking them
+            # up before __init__ has run would recurse)
+            raise AttributeError(attr_name)
         return self.getLayerByName(attr_name)
 
     def __repr__(self):
@@ -120,6 +435,18 @@ class LayerManager(list):
         return '[' + ','.join(items) + ']'
 
 class Layer(object):
+    """
+    Layer() is the baseclass of everything drawn by a LayerManager. Layers
+    draw in renderLayer(). Set isolated to True for layers that must be
+    drawn in a group of their own even when fully opaque (e.g. if they
+    paint with operators other than OVER). Set static to True for layers
+    that draw the same thing whenever their scheme, position and
+    cacheKey() are the same, so they can be cached. Set parallel_safe to
+    True for layers that only draw with self.context (not with fonts or
+    axes, which hold on to the graph's context) and so can be rendered
+    on a thread of their own; prepare() is called on the graph's thread
+    before they are.
+    """
 
     # Layer Specifics
     name = 'Unnamed Layer'
@@ -128,6 +455,9 @@ class Layer(object):
     context = None
     scheme = None
     padding = {'top': 0, 'left': 0, 'bottom': 0, 'right': 0}
+    isolated = False
+    static = False
+    parallel_safe = False
 
     # Manipulation Methods
     def zIndex(self): return self.manager.getStackPosition(self)
@@ -139,27 +469,67 @@ class Layer(object):
     def dimensions(self):
         return 0,0
 
-    def render(self, opacity=1):
+    def cacheKey(self):
+        """
+        Get a hashable value identifying what the layer draws, besides its
+        scheme and position, or None if it can't be cached.
+        """
+        return None
+
+    def prepare(self):
+        """
+        Compute anything the layer shares with other layers and caches
+        lazily (such as axis transforms) before it's rendered on a thread
+        of the render pool.
+        """
+        pass
+
+    def boundingBox(self):
+        """
+        Get the box (x, y, width, height) on the canvas that everything the
+        layer draws falls within, or None if it isn't known.
+        """
+        return None
+
+    def render(self, opacity=1, group=True, clip=None):
+        """
+        Render the layer. If group is True, it's drawn in an offscreen group
+        which is then painted with the given opacity; otherwise it's drawn
+        straight onto the target. If clip is a box (x, y, width, height),
+        drawing is clipped to it. (See LayerManager.compositingPlan.)
+        """
         if hasattr(self, 'initLayer') and callable(self.initLayer):
             self.initLayer()
         if hasattr(self, 'renderLayer') and callable(self.renderLayer):
-            self.context.push_group()
-            self.renderLayer()
-            self.context.pop_group_to_source()
-            self.context.paint_with_alpha(opacity)
+            self.context.save()
+            if clip is not None:
+                self.context.rectangle(*clip)
+                self.context.clip()
+            if group:
+                self.context.push_group()
+                self.renderLayer()
+                self.context.pop_group_to_source()
+                self.context.paint_with_alpha(opacity)
+            else:
+                self.renderLayer()
+            self.context.restore()
 
     def reposition(self, new_position):
         self.position = new_position
+        if self.manager is not None:
+            self.manager.invalidateBounds()
 
     def positionalBounds(self):
         """
-        Returns two tuples (within a tuple) that are the minimum and
-        maximum coordinates of the layer.
+        Returns the box (left, top, right, bottom) covered by the layer:
+        its bounding box if it has one, or else its position and
+        dimensions.
         """
-        dims = self.dimensions()
-        xrange = range(self.position[0], dims[0])
-        yrange = range(self.position[1], dims[1])
-        return (xrange, yrange)
+        box = self.boundingBox()
+        if box is None:
+            dims = self.dimensions()
+            box = (self.position[0], self.position[1], dims[0], dims[1])
+        return (box[0], box[1], box[0] + box[2], box[1] + box[3])
 
     ###################################################################
     # Op Overriding
@@ -168,12 +538,9 @@ class Layer(object):
     def __contains__(self, other):
         l1 = self.positionalBounds()
         if isinstance(other, Layer):
-            l2 = self.getLayerByName(layer2_name).positionalBounds()
-            if any([(x in l1[0]) for x in l2[0]]) and any([(x in l1[1]) for x in l2[1]]):
-                return True
+            return render_utils.boxesIntersect(l1, other.positionalBounds())
         elif isinstance(other, (tuple, list)):
-            if other[0] in l1[0] and other[1] in l1[1]:
-                return True
+            return l1[0] <= other[0] < l1[2] and l1[1] <= other[1] < l1[3]
         return False
 
     def __selfAndTargetDimensions(self, other):
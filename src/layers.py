@@ -23,8 +23,16 @@ from font import FontStyle
 
 class Background(Layer):
 
+    static = True
+
+    def cacheKey(self):
+        return ()
+
     def dimensions(self):
-        return self.canvas_dimensions
+        return self.manager.canvas_dimensions
+
+    def boundingBox(self):
+        return (0, 0) + tuple(self.manager.canvas_dimensions)
 
     def renderLayer(self):
         render_utils.setDynamicSource(self.context, self.scheme['color'])
@@ -32,9 +40,14 @@ class Background(Layer):
 
 class Title(Layer):
 
+    static = True
+
     def __init__(self, content):
         self.content = content
 
+    def cacheKey(self):
+        return (self.content,)
+
     def dimensions(self):
         width, height = self.scheme['font'].dimensions(self.content)
         height += self.scheme['margin-top']
@@ -64,6 +77,8 @@ class Legend(Layer):
 class Axes(Layer):
     
     from axis import Axis
+
+    static = True
     
     def __init__(self, dimensions, series, categories, independent_axis_orientation = 'horizontal'):
         self.__independentAxis = None
@@ -75,6 +90,11 @@ class Axes(Layer):
     
     def dimensions(self):
         return self.__dimensions
+
+    def cacheKey(self):
+        if self.__independentAxis is None or self.__dependentAxis is None:
+            return None
+        return (self.__independentAxis.cacheKey(), self.__dependentAxis.cacheKey())
     
     def __joinAxes(self):
         if self.__independentAxis and self.__dependentAxis:
@@ -19,6 +19,7 @@ import graph
 import layers
 import scheme, schemata
 import render_utils
+import decimation
 
 from layering import Layer
 
@@ -37,6 +38,13 @@ class LineGraph(graph.Graph):
         self.y_title = ''
         
     def render(self, output_file):
+        """
+        Render the graph to output_file: a path, or any object with a
+        write() method (such as a file or an HttpResponse), which the
+        output is streamed to.
+        """
+        self.bindFonts()
+        self.prefetchLabels(self.title, self.x_title, self.y_title)
         # create layers
         if self.layers.scheme['background']['enabled']:
             self.layers.new('background', layers.Background())
@@ -55,26 +63,68 @@ class LineGraph(graph.Graph):
             )
 
         # render and output
-        self.layers.renderAll()
-        self.output_interface.writeToFile(output_file)
+        try:
+            self.layers.renderAll()
+            self.output_interface.writeToFile(output_file)
+        finally:
+            self.fonts.flush() # keep what was measured, even on failure
 
     class Set(Layer):
 
+        parallel_safe = True
+
         def __init__(self, values, x_axis, y_axis):
             self.values = values
             self.y_axis = y_axis
             self.x_axis = x_axis
             self.zero_pos = self.y_axis.positionOfValue(0)
 
+        def prepare(self):
+            self.x_axis.prepare()
+            self.y_axis.prepare()
+
         def dimensions(self):
             w = self.width - ((self.width / 100) * self.scheme['series-spacing'])
             return (w, 200)
 
+        def points(self):
+            """
+            Get the x and y values of the line. Numeric titles are used as
+            x values as they are; other titles are replaced by their slot
+            on the x axis (Axis.titleSlot), the same slot as their label.
+            """
+            titles, ys = self.values.columns()
+            if not isinstance(titles, list):
+                return titles, ys # numeric array
+            xs = []
+            for title in titles:
+                if isinstance(title, bool) or \
+                    not isinstance(title, (int, long, float)):
+                    title = self.x_axis.titleSlot(title)
+                xs.append(title)
+            return xs, ys
+
+        def boundingBox(self):
+            xs, ys = self.points()
+            if not len(xs):
+                return None
+            x_positions = self.x_axis.positionsOfValues(xs)
+            y_positions = self.y_axis.positionsOfValues(ys)
+            pad = 10 # room for the stroke's miter joins
+            left, top = min(x_positions) - pad, min(y_positions) - pad
+            return (left, top, max(x_positions) + pad - left,
+                max(y_positions) + pad - top)
+
         def renderLayer(self):
             render_utils.setDynamicSource(self.context, '#000000')
-            for i, category in enumerate(self.values):
-                y_position = self.y_axis.positionOfValue(category[0])[1]
-                x_position = self.x_axis.positionOfValue(category.title)[0]
+            xs, ys = self.points()
+            xs, ys = decimation.decimate(xs, ys, \
+                self.scheme.get('decimation'), self.x_axis.length)
+            x_positions = self.x_axis.positionsOfValues(xs)
+            y_positions = self.y_axis.positionsOfValues(ys)
+            for i in xrange(len(xs)):
+                x_position = x_positions[i]
+                y_position = y_positions[i]
                 if i == 0:
                     self.context.move_to(x_position, y_position)
                 self.context.line_to(x_position, y_position)
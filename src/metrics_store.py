@@ -0,0 +1,153 @@
+# Copyright (c) 2007 by Kenneth Keiter <ken@kenkeiter.com>
+#
+# This file is part of django-graph.
+#
+# Django-graph is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Django-graph is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with django-graph.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+class MetricsStore(object):
+    """
+    MetricsStore() keeps text dimensions on disk in an SQLite database, so
+    that new processes start with the dimensions measured by earlier ones.
+    Dimensions are keyed by a digest of the font (see FontFace.digest),
+    size, rotation and content.
+
+    Several processes may share one database: it uses write-ahead logging
+    (readers never block the writer), waits for locks rather than failing,
+    and inserts with INSERT OR IGNORE, since any process measuring the same
+    text gets the same answer. Writes are buffered until flush(); if
+    flushing keeps failing, only the newest max_pending are kept.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS dimensions (
+            face TEXT NOT NULL,
+            size REAL NOT NULL,
+            rotation REAL NOT NULL,
+            content BLOB NOT NULL,
+            width REAL NOT NULL,
+            height REAL NOT NULL,
+            PRIMARY KEY (face, size, rotation, content)
+        )
+    '''
+
+    def __init__(self, path, timeout=30.0, max_pending=50000):
+        """
+        Open (creating if needed) the store at path.
+
+        Parameters:
+            path = the path of the SQLite database file
+            timeout = seconds to wait for another process's lock
+            max_pending = the most dimensions to hold while waiting to write
+                them (the oldest are dropped past that)
+        """
+        self.path = path
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = []
+        self.connection = None
+        self.pid = None
+        self.__connect()
+
+    def __connect(self):
+        # connections can't be carried across fork(), so each process
+        # opens its own
+        if self.connection is not None and self.pid == os.getpid():
+            return self.connection
+        self.connection = sqlite3.connect(self.path, timeout=self.timeout,
+            check_same_thread=False)
+        self.pid = os.getpid()
+        try:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            pass # e.g. on a network filesystem; the default journal works
+        self.connection.execute(self.SCHEMA)
+        self.connection.commit()
+        return self.connection
+
+    def load(self, face):
+        """
+        Get every dimension stored for a face.
+
+        Parameters:
+            face = the face's digest (str)
+
+        Returns:
+            A list of ((size, rotation, content), (width, height)) tuples
+        """
+        self.lock.acquire()
+        try:
+            rows = self.__connect().execute('SELECT size, rotation, content, '
+                'width, height FROM dimensions WHERE face = ?', (face,)).fetchall()
+        finally:
+            self.lock.release()
+        return [((size, rotation, str(content)), (width, height)) \
+            for size, rotation, content, width, height in rows]
+
+    def add(self, face, size, rotation, content, dimensions):
+        """
+        Add a dimension to be written at the next flush().
+        """
+        width, height = dimensions
+        self.lock.acquire()
+        try:
+            self.pending.append((face, size, rotation, buffer(content),
+                width, height))
+            if len(self.pending) > self.max_pending:
+                # dropped dimensions are only measured again later
+                del self.pending[:len(self.pending) - self.max_pending]
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """
+        Write pending dimensions in a single transaction. If the database
+        stays locked past the timeout (or can't be written), the failure is
+        logged and they are kept for the next flush.
+        """
+        self.lock.acquire()
+        try:
+            if not self.pending:
+                return
+            try:
+                connection = self.__connect()
+                connection.executemany('INSERT OR IGNORE INTO dimensions '
+                    'VALUES (?, ?, ?, ?, ?, ?)', self.pending)
+                connection.commit()
+            except sqlite3.OperationalError, e:
+                if self.connection is not None:
+                    self.connection.rollback()
+                log.warning('Unable to write %d text dimensions to %s: %s',
+                    len(self.pending), self.path, e)
+                return
+            self.pending = []
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.flush()
+        self.lock.acquire()
+        try:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+        finally:
+            self.lock.release()
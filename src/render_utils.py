@@ -31,6 +31,39 @@ def dehumanizeRotation(humanized_rotation):
         return humanized_rotation
     return rotations[humanized_rotation]
     
+def rotatedExtents(width, height, rotation):
+    """
+    Get the (width, height) of the box bounding a width x height box once
+    it's rotated (in degrees, or humanized).
+    """
+    angle = math.radians(dehumanizeRotation(rotation))
+    cos, sin = abs(math.cos(angle)), abs(math.sin(angle))
+    return (width * cos + height * sin, width * sin + height * cos)
+
+def freeze(obj):
+    """
+    Turn a (nested) scheme value into something hashable which compares
+    equal for equal values. Dicts and lists are frozen by their contents,
+    as are plain objects (gradients, etc.) by their attributes; objects
+    with a frozen() method (like FontStyle) freeze themselves.
+    """
+    if isinstance(obj, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in obj.iteritems()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    if hasattr(obj, 'frozen') and callable(obj.frozen):
+        return obj.frozen()
+    if hasattr(obj, '__dict__') and not callable(obj):
+        return (obj.__class__.__name__, freeze(vars(obj)))
+    return obj
+
+def boxesIntersect(a, b):
+    """
+    Determine whether two boxes in the format (left, top, right, bottom)
+    overlap. Boxes that only share an edge don't.
+    """
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
 def frange(lower_limit, upper_limit, increment = 1.0):
     lower_limit = float(lower_limit)
     count = int(math.ceil((upper_limit - lower_limit) / increment))
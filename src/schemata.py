@@ -76,6 +76,15 @@ def defaultBarScheme():
                     'margin-bottom': 0,
                     'color': '#000000',
                     'number-formatter': '%.2f',
+                    # pick a rotation, and then a subset of the labels,
+                    # so that they don't overlap (see Axis.visibleLabels).
+                    # Add 'diagonal' and 'vertical' to the rotations to
+                    # let crowded labels turn rather than be thinned.
+                    'thinning': {
+                        'enabled': True,
+                        'rotations': ['horizontal'],
+                        'gap': 4,
+                    },
                 },
                 'title': {
                     'enabled': True,
@@ -189,6 +198,11 @@ def defaultBarScheme():
             'background-transparency': 100, # percent
             'series-spacing': 10, # percent
             'set-spacing': 100, # percent
+            'decimation': { # line graphs only
+                'enabled': True, # or False
+                'method': 'min-max', # or 'lttb'
+                'samples-per-pixel': 1,
+            },
         }
     )
     style.addRule(
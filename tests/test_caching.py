@@ -0,0 +1,266 @@
+# Copyright (c) 2007 by Kenneth Keiter <ken@kenkeiter.com>
+#
+# This file is part of django-graph.
+#
+# Django-graph is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Django-graph is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with django-graph.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the remote cache helpers, using caching.LocalCache in place of a
+memcached client.
+"""
+
+import os
+import sys
+import zlib
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src'))
+
+import cairo
+import caching
+import font
+import graph
+from bar import VerticalBarGraph
+
+class CountingCache(caching.LocalCache):
+    """
+    A LocalCache counting the calls made to it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        caching.LocalCache.__init__(self, *args, **kwargs)
+        self.calls = {'get': 0, 'get_multi': 0, 'set': 0, 'set_multi': 0}
+
+    def get(self, key):
+        self.calls['get'] += 1
+        return caching.LocalCache.get(self, key)
+
+    def get_multi(self, keys):
+        self.calls['get_multi'] += 1
+        return caching.LocalCache.get_multi(self, keys)
+
+    def set(self, key, value):
+        self.calls['set'] += 1
+        return caching.LocalCache.set(self, key, value)
+
+    def set_multi(self, mapping):
+        self.calls['set_multi'] += 1
+        return caching.LocalCache.set_multi(self, mapping)
+
+class PlainCache(object):
+    """
+    A client with only get() and set(), like the simplest cache backends.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+class BlobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = caching.LocalCache()
+        self.data = os.urandom(2500 * 1024) # doesn't compress
+        self.assertTrue(caching.setBlob(self.client, 'font', self.data))
+
+    def chunkKeys(self):
+        return sorted(key for key in self.client.data if key != 'font')
+
+    def testLocalCacheItemLimit(self):
+        self.assertFalse(self.client.set('big', 'x' * (1024 * 1024 + 1)))
+        self.assertEqual(self.client.get('big'), None)
+
+    def testRoundTrip(self):
+        self.assertEqual(len(self.chunkKeys()), 3)
+        for key in self.chunkKeys():
+            self.assertTrue(len(self.client.get(key)) <= caching.BLOB_CHUNK_SIZE)
+        self.assertEqual(caching.getBlob(self.client, 'font'), self.data)
+
+    def testCompressed(self):
+        data = 'glyph ' * 500000
+        self.assertTrue(caching.setBlob(self.client, 'text', data))
+        self.assertEqual(self.client.get('text')['chunks'], 1)
+        self.assertEqual(caching.getBlob(self.client, 'text'), data)
+
+    def testPlainClient(self):
+        client = PlainCache()
+        self.assertTrue(caching.setBlob(client, 'font', self.data))
+        self.assertEqual(caching.getBlob(client, 'font'), self.data)
+
+    def testChunkTooLarge(self):
+        self.assertFalse(caching.setBlob(caching.LocalCache(), 'font',
+            self.data, chunk_size=2 * 1024 * 1024))
+
+    def testMissingManifest(self):
+        self.assertEqual(caching.getBlob(self.client, 'other'), None)
+        self.client.set('other', 'not a manifest')
+        self.assertEqual(caching.getBlob(self.client, 'other'), None)
+
+    def testMissingChunk(self):
+        self.client.delete(self.chunkKeys()[1])
+        self.assertEqual(caching.getBlob(self.client, 'font'), None)
+
+    def testCorruptChunk(self):
+        key = self.chunkKeys()[0]
+        chunk = self.client.get(key)
+        self.client.set(key, chunk[:100] + 'x' + chunk[101:])
+        self.assertEqual(caching.getBlob(self.client, 'font'), None)
+
+    def testChecksumMismatch(self):
+        # chunks that decompress fine, but to the wrong data
+        self.assertTrue(caching.setBlob(self.client, 'text', 'abc'))
+        key = [k for k in self.client.data if k.startswith('text.')][0]
+        self.client.set(key, zlib.compress('abd'))
+        self.assertEqual(caching.getBlob(self.client, 'text'), None)
+
+    def testRewrite(self):
+        data = os.urandom(1024)
+        self.assertTrue(caching.setBlob(self.client, 'font', data))
+        self.assertEqual(caching.getBlob(self.client, 'font'), data)
+
+class FontFileKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        # real paths, as getcwd() returns them (/tmp may be a symlink)
+        self.directories = [os.path.realpath(tempfile.mkdtemp()) \
+            for i in xrange(2)]
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        for directory in self.directories:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def testKeys(self):
+        keys = []
+        for directory in self.directories:
+            os.chdir(directory)
+            key = font.fontFileKey('font.ttf')
+            self.assertEqual(key, font.fontFileKey(
+                os.path.join(directory, 'font.ttf')))
+            self.assertEqual(key, font.fontFileKey(u'font.ttf'))
+            keys.append(key)
+        # the same relative path in two directories names two files
+        self.assertNotEqual(keys[0], keys[1])
+        self.assertEqual(keys[0], 'djangographs.fonts.files.' +
+            hashlib.md5(os.path.join(self.directories[0], 'font.ttf')).hexdigest())
+
+class WriteBehindCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = CountingCache()
+        self.cache = caching.WriteBehindCache(self.client, max_pending=10,
+            background_min=2)
+
+    def testPendingReads(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.client.calls['get'], 0)
+        self.assertEqual(self.client.get('a'), None)
+
+    def testFlush(self):
+        for i in xrange(5):
+            self.cache.set(i, i)
+        self.cache.flush()
+        self.assertEqual(self.client.calls['set_multi'], 1)
+        self.assertEqual(self.client.data, dict((i, i) for i in xrange(5)))
+
+    def testFlushWhenFull(self):
+        for i in xrange(10):
+            self.cache.set(i, i)
+        self.assertEqual(len(self.client.data), 10)
+        self.assertEqual(self.cache.pending, {})
+
+    def testGetMulti(self):
+        self.client.set('remote', 1)
+        self.cache.set('pending', 2)
+        self.assertEqual(self.cache.get_multi(['remote', 'pending', 'none']),
+            {'remote': 1, 'pending': 2})
+        self.assertEqual(self.client.calls['get_multi'], 1)
+
+    def testBackgroundFlush(self):
+        self.cache.set('a', 1)
+        self.cache.flush(background=True) # small -- written straight away
+        self.assertEqual(self.client.data, {'a': 1})
+        self.cache.set('b', 2)
+        self.cache.set('c', 3)
+        self.cache.flush(background=True)
+        caching.waitForWrites()
+        self.assertEqual(self.client.data, {'a': 1, 'b': 2, 'c': 3})
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 100, 100)
+        self.context = cairo.Context(surface)
+        self.client = CountingCache()
+        font.registry.dimensions.clear()
+
+    def tearDown(self):
+        font.registry.dimensions.clear()
+
+    def testPrefetch(self):
+        book = font.FontBook(self.context, cache=self.client)
+        style = font.FontStyle(book=book, face='sans', size=12)
+        dimensions = style.dimensions('prefetched')
+        book.flush()
+        self.assertEqual(self.client.calls['set_multi'], 1)
+
+        # a fresh process: nothing is cached locally
+        font.registry.dimensions.clear()
+        self.client.calls['get'] = 0
+        book = font.FontBook(self.context, cache=self.client)
+        style = font.FontStyle(book=book, face='sans', size=12)
+        book.prefetch([(style, 'prefetched', 0), (style, 'unknown', 0)])
+        self.assertEqual(self.client.calls['get_multi'], 1)
+        self.assertEqual(style.dimensions('prefetched'), dimensions)
+        self.assertEqual(self.client.calls['get'], 0)
+
+    def testRenderPrefetch(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for run in xrange(2):
+                # each run as a fresh process: nothing is cached locally
+                font.registry.dimensions.clear()
+                self.client.calls['get'] = self.client.calls['get_multi'] = 0
+                g = VerticalBarGraph(dimensions=(300, 200), cache=self.client)
+                g.title, g.x_title, g.y_title = 'Sales', 'Quarter', 'Units'
+                g.importSeries(graph.Series('a', {'q1': 10, 'q2': 20}),
+                    graph.Series('b', {'q1': 3, 'q2': 8}))
+                g.render(os.path.join(directory, 'graph.png'))
+                caching.waitForWrites()
+            # every label is fetched in one call, so none is fetched alone
+            self.assertEqual(self.client.calls['get_multi'], 1)
+            self.assertEqual(self.client.calls['get'], 0)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def testPrefetchSkipsLocal(self):
+        book = font.FontBook(self.context, cache=self.client)
+        style = font.FontStyle(book=book, face='sans', size=12)
+        style.dimensions('local')
+        book.prefetch([(style, 'local', 0)])
+        self.assertEqual(self.client.calls['get_multi'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
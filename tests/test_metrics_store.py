@@ -0,0 +1,102 @@
+# Copyright (c) 2007 by Kenneth Keiter <ken@kenkeiter.com>
+#
+# This file is part of django-graph.
+#
+# Django-graph is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Django-graph is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with django-graph.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the on-disk MetricsStore, against a temporary SQLite database.
+"""
+
+import os
+import sys
+import shutil
+import sqlite3
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src'))
+
+import metrics_store
+from metrics_store import MetricsStore
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class MetricsStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'metrics.sqlite3')
+        self.handler = RecordingHandler()
+        metrics_store.log.addHandler(self.handler)
+
+    def tearDown(self):
+        metrics_store.log.removeHandler(self.handler)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testRoundTrip(self):
+        store = MetricsStore(self.path)
+        store.add('face', 12, 0, 'label', (30.5, 12.0))
+        store.add('face', 12, 90, 'label', (12.0, 30.5))
+        store.add('other', 10, 0, 'label', (1.0, 1.0))
+        self.assertEqual(store.load('face'), []) # not flushed yet
+        store.close()
+        store = MetricsStore(self.path) # as a new process would
+        self.assertEqual(sorted(store.load('face')), [
+            ((12, 0, 'label'), (30.5, 12.0)),
+            ((12, 90, 'label'), (12.0, 30.5)),
+        ])
+        store.close()
+
+    def testDuplicates(self):
+        first, second = MetricsStore(self.path), MetricsStore(self.path)
+        first.add('face', 12, 0, 'label', (30.5, 12.0))
+        second.add('face', 12, 0, 'label', (30.5, 12.0))
+        first.flush()
+        second.flush()
+        self.assertEqual(second.pending, [])
+        self.assertEqual(len(first.load('face')), 1)
+        first.close()
+        second.close()
+
+    def testLocked(self):
+        store = MetricsStore(self.path, timeout=0.1, max_pending=3)
+        locker = sqlite3.connect(self.path)
+        locker.execute('BEGIN EXCLUSIVE')
+        for i in xrange(5):
+            store.add('face', 12, 0, 'label %d' % i, (i, i))
+        store.flush()
+        # kept for the next flush (only the newest), and the failure logged
+        self.assertEqual([str(row[3]) for row in store.pending],
+            ['label 2', 'label 3', 'label 4'])
+        self.assertEqual(len(self.handler.records), 1)
+        locker.rollback()
+        locker.close()
+        store.flush()
+        self.assertEqual(store.pending, [])
+        self.assertEqual(sorted(content for (size, rotation, content), dims \
+            in store.load('face')), ['label 2', 'label 3', 'label 4'])
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
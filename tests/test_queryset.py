@@ -0,0 +1,135 @@
+# Copyright (c) 2007 by Kenneth Keiter <ken@kenkeiter.com>
+#
+# This file is part of django-graph.
+#
+# Django-graph is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Django-graph is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with django-graph.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for Series.fromQuerySet() against a temporary SQLite database.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src'))
+
+from django.conf import settings
+
+database_dir = tempfile.mkdtemp()
+if not settings.configured:
+    settings.configure(
+        DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(database_dir, 'graphs.sqlite3'),
+        }},
+        INSTALLED_APPS=[],
+        USE_TZ=False,
+    )
+
+import django
+django.setup()
+from django.db import connection, models
+from django.test.utils import CaptureQueriesContext
+
+import graph
+
+class Reading(models.Model):
+    taken = models.DateTimeField()
+    sensor = models.CharField(max_length=16)
+    value = models.FloatField(null=True)
+
+    class Meta:
+        app_label = 'graphs_tests'
+
+def setUpModule():
+    editor = connection.schema_editor()
+    editor.__enter__()
+    try:
+        editor.create_model(Reading)
+    finally:
+        editor.__exit__(None, None, None)
+    start = datetime(2009, 1, 1)
+    readings = []
+    for minute in xrange(180): # three hours of per-minute readings
+        readings.append(Reading(taken=start + timedelta(minutes=minute),
+            sensor='ab'[minute % 2], value=float(minute)))
+    readings.append(Reading(taken=start + timedelta(minutes=180),
+        sensor='c', value=None))
+    Reading.objects.bulk_create(readings)
+
+def tearDownModule():
+    connection.close()
+    shutil.rmtree(database_dir, ignore_errors=True)
+
+def values(series):
+    return [category[0] for category in series]
+
+class FromQuerySetTest(unittest.TestCase):
+
+    def testRows(self):
+        series = graph.Series('value').fromQuerySet(
+            Reading.objects.filter(sensor='a'), x='taken', y='value')
+        self.assertTrue(series.columnar)
+        self.assertEqual(len(series), 90)
+        self.assertEqual(series.titles[0], datetime(2009, 1, 1))
+        self.assertEqual(series.titles[-1], datetime(2009, 1, 1, 2, 58))
+        self.assertEqual(series.stats.count, 90)
+        self.assertEqual(series.stats.maximum, 178.0)
+
+    def testChunks(self):
+        series = graph.Series('value').fromQuerySet(Reading.objects.all(),
+            x='taken', y='value', chunk_size=7)
+        self.assertEqual(len(series), 180) # the None reading is skipped
+        self.assertEqual(series.titles, sorted(series.titles))
+        self.assertEqual(sum(values(series)), sum(xrange(180)))
+        self.assertEqual(series.stats.total, sum(xrange(180)))
+
+    def testAggregate(self):
+        series = graph.Series('total').fromQuerySet(Reading.objects.all(),
+            x='sensor', y='value', aggregate='sum')
+        self.assertEqual(series.titles, ['a', 'b']) # c's sum is NULL
+        self.assertEqual(values(series),
+            [float(sum(xrange(0, 180, 2))), float(sum(xrange(1, 180, 2)))])
+
+    def testAggregateClass(self):
+        series = graph.Series('count').fromQuerySet(Reading.objects.all(),
+            x='sensor', y='value', aggregate=models.Count)
+        self.assertEqual(values(series), [90.0, 90.0, 0.0])
+
+    def testBucket(self):
+        captured = CaptureQueriesContext(connection)
+        captured.__enter__()
+        try:
+            series = graph.Series('hourly').fromQuerySet(
+                Reading.objects.all(), x='taken', y='value', bucket='hour')
+        finally:
+            captured.__exit__(None, None, None)
+        # grouped and averaged by the database, in a single query
+        self.assertEqual(len(captured.captured_queries), 1)
+        self.assertTrue('GROUP BY' in captured.captured_queries[0]['sql'])
+        self.assertEqual(series.titles, [datetime(2009, 1, 1, hour) \
+            for hour in xrange(3)])
+        self.assertEqual(values(series), [29.5, 89.5, 149.5])
+
+    def testUnknownAggregate(self):
+        self.assertRaises(ValueError, graph.Series('bad').fromQuerySet,
+            Reading.objects.all(), x='sensor', y='value', aggregate='median')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# Copyright (c) 2007 by Kenneth Keiter <ken@kenkeiter.com>
+#
+# This file is part of django-graph.
+#
+# Django-graph is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Django-graph is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with django-graph.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for switching list-backed Series to columnar storage.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src'))
+
+import graph
+
+class ColumnarTest(unittest.TestCase):
+
+    def testConvert(self):
+        series = graph.Series('s')
+        series.append('a', 1.0)
+        series.append('b', 2.0)
+        series.fromArrays(['c', 'd'], [3.0, 4.0])
+        self.assertTrue(series.columnar)
+        self.assertEqual(series.titles, ['a', 'b', 'c', 'd'])
+        self.assertEqual([category[0] for category in series],
+            [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(series.index('c'), 2)
+
+    def testConvertFails(self):
+        for bad in ('two', None):
+            series = graph.Series('s')
+            series.append('a', 1.0)
+            series.append('b', bad)
+            series.append('c', 3.0)
+            self.assertRaises(TypeError, series.fromArrays, ['d'], [4.0])
+            # left as it was, rather than half moved into columns
+            self.assertFalse(series.columnar)
+            self.assertEqual(series.titles, ['a', 'b', 'c'])
+            self.assertEqual([category[0] for category in series],
+                [1.0, bad, 3.0])
+            self.assertEqual(series.index('c'), 2)
+            series.append('d', 4.0)
+            self.assertEqual(len(series), 4)
+
+if __name__ == '__main__':
+    unittest.main()